@@ -4,6 +4,9 @@ from .decorators import (login_required, admin_required, user_to_request,  # noq
                          restricted_api)
 from .utils import url_for  # noqa
 from . import flash  # noqa
+from . import passwords
+from . import sweeper
+from . import timing
 
 
 def setup(app, storage, config=None):
@@ -11,6 +14,21 @@ def setup(app, storage, config=None):
     config['APP'] = app
     config['STORAGE'] = storage
     cfg.configure(config)
+    if cfg.SERVER_TIMING_SAMPLE_RATE:
+        cfg['STORAGE'] = timing.TimedStorage(storage)
+        # the outermost one, so the session load is timed too
+        app.middlewares.insert(0, timing.middleware)
+    if cfg.PASSWORD_HASH_TARGET_TIME:
+        passwords.calibrate(cfg.PASSWORD_HASH_TARGET_TIME)
+    app.on_cleanup.append(passwords.shutdown)
+    if hasattr(storage, 'on_startup'):
+        app.on_startup.append(storage.on_startup)
+    if hasattr(storage, 'on_cleanup'):
+        app.on_cleanup.append(storage.on_cleanup)
+    if cfg.CLEANUP_INTERVAL and hasattr(storage,
+                                        'delete_expired_confirmations'):
+        app.on_startup.append(sweeper.start)
+        app.on_cleanup.append(sweeper.stop)
 
     add_route = app.router.add_route
     add_resource = app.router.add_resource
@@ -66,3 +84,7 @@ def setup(app, storage, config=None):
     router.add_route('GET', handlers.confirmation)
     router.add_route('POST', handlers.confirmation)
 
+    if cfg.METRICS_URL:
+        add_route('GET', cfg.METRICS_URL, handlers.metrics_handler,
+                  name='auth_metrics')
+
@@ -1,8 +1,18 @@
+import asyncio
+from time import monotonic
+from itertools import cycle
 from logging import getLogger
+from collections import OrderedDict
 from datetime import datetime
+from functools import lru_cache
+from contextvars import ContextVar
 
-from .utils import get_random_string
-from . import sql
+import asyncpg
+from aiohttp.web import HTTPException
+
+from .cfg import cfg
+from .utils import get_random_string, cur_user_fields
+from . import instrumentation, sql
 
 
 log = getLogger(__name__)
@@ -11,56 +21,296 @@ log = getLogger(__name__)
 class AsyncpgStorage:
     def __init__(self, pool, *,
                  user_table_name='users',
-                 confirmation_table_name='confirmations'):
+                 confirmation_table_name='confirmations',
+                 user_cache=None,
+                 invalidation_bus=None,
+                 warm_up=False,
+                 read_pools=None,
+                 read_your_writes=5):
         self.pool = pool
+        # replicas for `get_user` and `get_confirmation`, records written by
+        # this node are read from the primary for `read_your_writes` seconds
+        self.read_pools = read_pools or []
+        self.next_read_pool = cycle(self.read_pools).__next__
+        self.read_your_writes = read_your_writes
+        self.recent_writes = OrderedDict()
+        self.warm_up_on_startup = warm_up
         self.user_tbl = user_table_name
         self.confirm_tbl = confirmation_table_name
+        self.user_cache = user_cache
+        self.invalidation_bus = invalidation_bus
+        if invalidation_bus:
+            invalidation_bus.subscribe(self._on_invalidation,
+                                       self._on_invalidation_reset)
+        self.current_pin = ContextVar(
+            'aiohttp_login_pin_{}'.format(id(self)), default=None)
+
+    def acquire(self):
+        '''Acquires a connection from the pool, or returns the one pinned to
+        the current request
+        '''
+        pin = self.current_pin.get()
+        if pin is not None:
+            return pin.use()
+        return instrumentation.acquire(self.pool, 'primary')
+
+    def acquire_for_read(self, filter):
+        '''Acquires a connection of a read replica, unless the record was
+        written recently or a connection is pinned
+        '''
+        if (not self.read_pools or self.current_pin.get() is not None or
+                self.is_written_recently(filter)):
+            return self.acquire()
+        return instrumentation.acquire(self.next_read_pool(), 'replica')
+
+    def pin_to_primary(self, user):
+        '''Makes reads of the user go to the primary for a while'''
+        self.mark_written(id=user['id'], email=user.get('email'))
+
+    def mark_written(self, **keys):
+        if not self.read_pools:
+            return
+        expires_at = monotonic() + self.read_your_writes
+        for key in _read_your_writes_keys(keys):
+            self.recent_writes[key] = expires_at
+            self.recent_writes.move_to_end(key)
+
+    def is_written_recently(self, filter):
+        now = monotonic()
+        while self.recent_writes:
+            key, expires_at = next(iter(self.recent_writes.items()))
+            if expires_at > now:
+                break
+            del self.recent_writes[key]
+        return any(key in self.recent_writes
+                   for key in _read_your_writes_keys(filter))
+
+    def pinned(self, transaction=False):
+        '''Pins one connection to all the storage calls inside the block:
 
-    async def get_user(self, filter):
-        async with self.pool.acquire() as conn:
-            return await sql.find_one(conn, self.user_tbl, filter)
+            async with storage.pinned(transaction=True):
+                user = await storage.create_user(...)
+                await storage.create_confirmation(user, 'registration')
+
+        Concurrent calls inside the block (e.g. of a lazy user) take turns
+        on the connection. Users changed inside a transaction are evicted
+        from caches after the commit.
+        '''
+        return _Pinned(self, transaction)
+
+    def pinning_middleware(self, transaction=False):
+        '''Pins a connection for the whole request:
+
+            app.middlewares.append(storage.pinning_middleware())
+        '''
+        async def middleware(app, handler):
+            async def process(request):
+                async with self.pinned(transaction):
+                    return await handler(request)
+            return process
+        return middleware
+
+    async def get_user(self, filter, fields=None):
+        async with self.acquire_for_read(filter) as conn:
+            return await sql.find_one(conn, self.user_tbl, filter, fields)
 
     async def create_user(self, data):
         data.setdefault('created_at', datetime.utcnow())
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             data['id'] = await sql.insert(conn, self.user_tbl, data)
+        self.mark_written(id=data['id'], email=data.get('email'))
         return data
 
+    async def bulk_create_users(self, users):
+        '''Inserts users with COPY. If the batch fails (e.g. an email is
+        taken), inserts them one by one to find the bad rows.
+        Returns `[(index, error), ...]` of not inserted users.
+        '''
+        now = datetime.utcnow()
+        for user in users:
+            user.setdefault('created_at', now)
+        columns = sorted(set().union(*users))
+        records = [tuple(user.get(c) for c in columns) for user in users]
+        try:
+            async with self.acquire() as conn:
+                async with _savepoint(conn):
+                    await conn.copy_records_to_table(
+                        self.user_tbl, records=records, columns=columns)
+            return []
+        except asyncpg.PostgresError as e:
+            log.warning('Bulk insert failed, retrying one by one: %s', e)
+
+        errors = []
+        for index, user in enumerate(users):
+            try:
+                async with self.acquire() as conn:
+                    async with _savepoint(conn):
+                        await sql.insert(conn, self.user_tbl, user, None)
+            except asyncpg.PostgresError as e:
+                errors.append((index, str(e)))
+        return errors
+
     async def update_user(self, user, updates):
-        async with self.pool.acquire() as conn:
+        self.mark_written(id=user['id'], email=updates.get('email'))
+        self.pin_to_primary(user)
+        async with self.acquire() as conn:
             await sql.update(conn, self.user_tbl, {'id': user['id']}, updates)
+            await self.invalidate_user(user, conn)
 
     async def delete_user(self, user):
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             await sql.delete(conn, self.user_tbl, {'id': user['id']})
+            await self.invalidate_user(user, conn)
+
+    async def invalidate_user(self, user, conn=None):
+        pin = self.current_pin.get()
+        if pin is not None and pin.transaction:
+            # before the commit other requests would refill the cache with
+            # the old row
+            pin.changed_users.append(user)
+            return
+        if self.user_cache:
+            self.user_cache.invalidate(user['id'])
+        if not self.invalidation_bus:
+            return
+        if conn is None and pin is not None:
+            async with pin.use() as conn:
+                await self.invalidation_bus.publish(
+                    self.user_session_id(user), conn=conn)
+        else:
+            await self.invalidation_bus.publish(
+                self.user_session_id(user), conn=conn)
+
+    def _on_invalidation(self, id_str):
+        user_id = self.user_id_from_string(id_str)
+        if self.user_cache and user_id:
+            self.user_cache.invalidate(user_id)
+
+    def _on_invalidation_reset(self):
+        if self.user_cache:
+            self.user_cache.clear()
+
+    async def on_startup(self, app):
+        if self.invalidation_bus:
+            await self.invalidation_bus.start()
+        if self.warm_up_on_startup:
+            await self.warm_up()
+
+    def hot_statements(self):
+        return _hot_statements(self.user_tbl, self.confirm_tbl)
+
+    async def warm_up(self):
+        '''Prepares the hot statements on the idle pool connections, so the
+        first requests don't pay for parsing and planning. Statements are run
+        with NULL arguments, which puts them into asyncpg statement caches.
+        Connections opened later are warmed by `init_connection`.
+        '''
+        statements = self.hot_statements()
+        for pool in [self.pool] + self.read_pools:
+            # only idle connections are taken, others can be held for
+            # a long time, e.g. by the invalidation bus listener
+            conns = []
+            try:
+                for _ in range(min(pool.get_min_size(),
+                                   pool.get_idle_size())):
+                    conns.append(await pool.acquire())
+                await asyncio.gather(*[
+                    self._warm_up_connection(conn, statements)
+                    for conn in conns])
+            finally:
+                for conn in conns:
+                    await pool.release(conn)
+
+    async def _warm_up_connection(self, conn, statements):
+        await _prepare(conn, statements)
+
+    async def on_cleanup(self, app):
+        if self.invalidation_bus:
+            await self.invalidation_bus.stop()
 
     async def create_confirmation(self, user, action, data=None):
-        async with self.pool.acquire() as conn:
+        '''Creates a confirmation in one statement, replacing the previous
+        one of the same user and action
+        '''
+        confirmation = {
+            'user_id': user['id'],
+            'action': action,
+            'data': data,
+            'created_at': datetime.utcnow(),
+        }
+        async with self.acquire() as conn:
             while True:
-                code = get_random_string(30)
-                if not await sql.find_one(conn, self.confirm_tbl,
-                                          {'code': code}):
-                    break
-            confirmation = {
-                'code': code,
-                'user_id': user['id'],
-                'action': action,
-                'data': data,
-                'created_at': datetime.utcnow(),
-            }
-            await sql.insert(conn, self.confirm_tbl, confirmation, None)
-            return confirmation
+                confirmation['code'] = get_random_string(30)
+                try:
+                    async with _savepoint(conn):
+                        await sql.upsert(conn, self.confirm_tbl,
+                                         confirmation, ['user_id', 'action'])
+                except asyncpg.UniqueViolationError as e:
+                    # the code is taken, it's very unlikely with 30 random
+                    # chars, but not impossible
+                    log.warning('Confirmation code collision', exc_info=e)
+                    continue
+                self.mark_written(id=user['id'], code=confirmation['code'])
+                return confirmation
 
     async def get_confirmation(self, filter):
         if 'user' in filter:
             filter['user_id'] = filter.pop('user')['id']
-        async with self.pool.acquire() as conn:
+        async with self.acquire_for_read(filter) as conn:
             return await sql.find_one(conn, self.confirm_tbl, filter)
 
     async def delete_confirmation(self, confirmation):
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             await sql.delete(conn, self.confirm_tbl,
                              {'code': confirmation['code']})
+        self.mark_written(id=confirmation['user_id'],
+                          code=confirmation['code'])
+
+    async def consume_confirmation(self, code, min_created_at):
+        '''Deletes not expired confirmation and applies it to the user:
+        activates registration or changes email. All in one statement.
+
+        `min_created_at` is `{action: datetime}`, other actions are ignored.
+        Returns `(confirmation, user)` or `(None, None)`.
+        '''
+        actions = tuple(sorted(min_created_at))
+        statement = _consume_confirmation_stmt(
+            self.user_tbl, self.confirm_tbl, actions)
+        values = [code]
+        for action in actions:
+            values += [action, min_created_at[action]]
+        async with self.acquire() as conn:
+            log.debug(sql.LOG_TPL, statement, values)
+            row = await conn.fetchrow(statement, *values)
+            if not row:
+                return None, None
+            user = dict(row)
+            confirmation = {
+                key: user.pop('_c_' + key) for key in
+                ['code', 'user_id', 'action', 'data', 'created_at']}
+            self.pin_to_primary(user)
+            # the notification goes through the same connection
+            await self.invalidate_user(user, conn)
+        return confirmation, user
+
+    async def delete_expired_confirmations(self, min_created_at, limit):
+        '''Deletes up to `limit` confirmations created before
+        `min_created_at` (`{action: datetime}`) and users who didn't confirm
+        their registration. Returns the number of deleted confirmations and
+        ids of deleted users.
+        '''
+        actions = tuple(sorted(min_created_at))
+        statement = _delete_expired_stmt(
+            self.user_tbl, self.confirm_tbl, actions)
+        values = [limit]
+        for action in actions:
+            values += [action, min_created_at[action]]
+        async with self.acquire() as conn:
+            log.debug(sql.LOG_TPL, statement, values)
+            row = await conn.fetchrow(statement, *values)
+            for user_id in row['user_ids']:
+                await self.invalidate_user({'id': user_id}, conn)
+        return row['confirmations'], row['user_ids']
 
     def user_id_from_string(self, id_str):
         try:
@@ -70,3 +320,182 @@ class AsyncpgStorage:
 
     def user_session_id(self, user):
         return str(user['id'])
+
+
+def _read_your_writes_keys(fields):
+    '''
+    >>> _read_your_writes_keys({'user_id': 1, 'email': 'Foo@Bar', 'name': 2})
+    [('id', 1), ('email', 'foo@bar')]
+    '''
+    keys = []
+    for field, value in fields.items():
+        if value is None:
+            continue
+        if field in ('id', 'user_id'):
+            keys.append(('id', value))
+        elif field == 'email':
+            keys.append(('email', value.lower()))
+        elif field == 'code':
+            keys.append(('code', value))
+    return keys
+
+
+class _PinnedConnection:
+    '''Gives the pinned connection to one storage call at a time'''
+    def __init__(self, pin):
+        self.pin = pin
+
+    async def __aenter__(self):
+        await self.pin.lock.acquire()
+        return self.pin.conn
+
+    async def __aexit__(self, *args):
+        self.pin.lock.release()
+
+
+class _Pinned:
+    def __init__(self, storage, transaction):
+        self.storage = storage
+        self.transaction = transaction
+        self.token = None
+        self.lock = asyncio.Lock()
+        self.changed_users = []
+
+    def use(self):
+        return _PinnedConnection(self)
+
+    async def __aenter__(self):
+        outer = self.storage.current_pin.get()
+        if outer is not None:
+            # nested blocks use the outer connection
+            return outer.conn
+        self.conn = await self.storage.pool.acquire()
+        self.token = self.storage.current_pin.set(self)
+        if self.transaction:
+            self.tr = self.conn.transaction()
+            try:
+                await self.tr.start()
+            except BaseException:
+                await self._release()
+                raise
+        return self.conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.token is None:
+            return
+        try:
+            if self.transaction:
+                # waits for calls still running on the connection
+                async with self.lock:
+                    # redirects and other non-error http exceptions are
+                    # responses
+                    if exc is None or (isinstance(exc, HTTPException) and
+                                       exc.status < 400):
+                        await self.tr.commit()
+                    else:
+                        await self.tr.rollback()
+        finally:
+            await self._release()
+
+    async def _release(self):
+        self.storage.current_pin.reset(self.token)
+        self.token = None
+        try:
+            for user in self.changed_users:
+                await self.storage.invalidate_user(user, conn=self.conn)
+        finally:
+            await self.storage.pool.release(self.conn)
+
+
+class _NoSavepoint:
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, *args):
+        pass
+
+
+def _savepoint(conn):
+    # a failed statement breaks the whole transaction, unless it's
+    # wrapped into a savepoint
+    if conn.is_in_transaction():
+        return conn.transaction()
+    return _NoSavepoint()
+
+
+async def init_connection(conn, *, user_table_name='users',
+                          confirmation_table_name='confirmations'):
+    '''Prepares the hot statements on a new connection, to be passed as
+    `init` of `asyncpg.create_pool()` (with `functools.partial` for custom
+    table names). Connections opened before `aiohttp_login.setup()` are
+    skipped, `AsyncpgStorage(pool, warm_up=True)` warms them on startup.
+    '''
+    if cfg.configured:
+        await _prepare(conn, _hot_statements(
+            user_table_name, confirmation_table_name))
+
+
+def _hot_statements(users, confirm):
+    # run by most of the requests: loading of the current user (with
+    # `SESSION_USER_FIELDS` projection), login and confirmation
+    return [
+        sql.find_one_sql(users, {'id': None}, cur_user_fields())[0],
+        sql.find_one_sql(users, {'email': None})[0],
+        sql.find_one_sql(confirm, {'code': None})[0],
+    ]
+
+
+async def _prepare(conn, statements):
+    for statement in statements:
+        await conn.fetchrow(statement, None)
+
+
+@lru_cache(sql.STATEMENT_CACHE_SIZE)
+def _consume_confirmation_stmt(users, confirm, actions):
+    expiration = ' OR '.join(
+        '(action=${} AND created_at>${})'.format(i, i + 1)
+        for i in range(2, len(actions) * 2 + 2, 2))
+    return '''
+        WITH c AS (
+            DELETE FROM {confirm} WHERE code=$1 AND ({expiration})
+            RETURNING *
+        )
+        UPDATE {users} SET
+            status = CASE WHEN c.action='registration'
+                THEN 'active' ELSE {users}.status END,
+            email = CASE WHEN c.action='change_email'
+                THEN c.data ELSE {users}.email END
+        FROM c WHERE {users}.id=c.user_id
+        RETURNING {users}.*, c.code AS _c_code, c.user_id AS _c_user_id,
+            c.action AS _c_action, c.data AS _c_data,
+            c.created_at AS _c_created_at
+    '''.format(confirm=confirm, users=users, expiration=expiration)
+
+
+@lru_cache(sql.STATEMENT_CACHE_SIZE)
+def _delete_expired_stmt(users, confirm, actions):
+    expiration = ' OR '.join(
+        '(action=${} AND created_at<${})'.format(i, i + 1)
+        for i in range(2, len(actions) * 2 + 2, 2))
+    # concurrent cleanups of a few nodes skip each others rows
+    return '''
+        WITH expired AS (
+            SELECT code FROM {confirm} WHERE {expiration}
+            LIMIT $1 FOR UPDATE SKIP LOCKED
+        ), c AS (
+            DELETE FROM {confirm} USING expired
+            WHERE {confirm}.code=expired.code
+            RETURNING {confirm}.user_id, {confirm}.action
+        ), u AS (
+            DELETE FROM {users} USING c
+            WHERE {users}.id=c.user_id AND c.action='registration'
+                AND {users}.status='confirmation'
+                AND NOT EXISTS (
+                    SELECT 1 FROM {confirm} other
+                    WHERE other.user_id={users}.id
+                        AND other.code NOT IN (SELECT code FROM expired))
+            RETURNING {users}.id
+        )
+        SELECT (SELECT count(*) FROM c) AS confirmations,
+            array(SELECT id FROM u) AS user_ids
+    '''.format(confirm=confirm, users=users, expiration=expiration)
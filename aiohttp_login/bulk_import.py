@@ -0,0 +1,223 @@
+'''
+Bulk import of users from CSV or JSONL files.
+
+Every row needs `email` and either `password` (plain, it's hashed in
+a process pool) or `password_hash`. `name`, `status` and social ids are
+optional. Rows which can't be imported are reported, the import goes on.
+
+    python -m aiohttp_login.bulk_import --dsn postgres:///db users.csv
+    python -m aiohttp_login.bulk_import --mongo mongodb:///db users.jsonl
+
+or from code:
+
+    stats = await import_users(storage, read_rows('users.csv'))
+'''
+import os
+import sys
+import csv
+import json
+import time
+import asyncio
+import argparse
+from logging import getLogger
+from concurrent.futures import ProcessPoolExecutor
+
+from passlib.context import CryptContext
+
+from .cfg import DEFAULTS
+
+
+log = getLogger(__name__)
+HASH_CHUNK_SIZE = 100
+
+
+async def import_users(storage, rows, *, batch_size=1000, workers=None,
+                       password_context=None, errors=None):
+    '''Imports users from `rows` iterable of dicts
+
+    Passwords of a batch are hashed in a process pool while the previous
+    batch is being written. Failed rows are appended to `errors` list as
+    `{'row': number, 'email': ..., 'error': ...}`.
+    '''
+    password_context = password_context or DEFAULTS['PASSWORD_CONTEXT']
+    errors = [] if errors is None else errors
+    stats = {'imported': 0, 'failed': 0}
+    started = time.perf_counter()
+    loop = asyncio.get_event_loop()
+
+    with ProcessPoolExecutor(workers) as executor:
+        writing = None
+        for batch in _batches(enumerate(rows, 1), batch_size):
+            users = await _prepare(loop, executor, password_context, batch,
+                                   errors)
+            if writing:
+                await writing
+            writing = asyncio.ensure_future(
+                _write(storage, users, stats, errors))
+        if writing:
+            await writing
+
+    stats['failed'] = len(errors)
+    stats['elapsed'] = time.perf_counter() - started
+    stats['users_per_second'] = stats['imported'] / (stats['elapsed'] or 1)
+    return stats
+
+
+async def _prepare(loop, executor, password_context, batch, errors):
+    users, to_hash = [], []
+    for number, row in batch:
+        try:
+            user = _user_from_row(row)
+        except ValueError as e:
+            errors.append({'row': number, 'email': row.get('email'),
+                           'error': str(e)})
+            continue
+        users.append((number, user))
+        if 'password' not in user:
+            to_hash.append((user, row['password']))
+
+    chunks = [to_hash[i:i + HASH_CHUNK_SIZE]
+              for i in range(0, len(to_hash), HASH_CHUNK_SIZE)]
+    hashes = await asyncio.gather(*[
+        loop.run_in_executor(executor, _hash_passwords, password_context,
+                             [password for _, password in chunk])
+        for chunk in chunks])
+    for chunk, chunk_hashes in zip(chunks, hashes):
+        for (user, _), password_hash in zip(chunk, chunk_hashes):
+            user['password'] = password_hash
+    return users
+
+
+async def _write(storage, users, stats, errors):
+    if not users:
+        return
+    failed = await storage.bulk_create_users([user for _, user in users])
+    for index, error in failed:
+        number, user = users[index]
+        errors.append({'row': number, 'email': user['email'],
+                       'error': error})
+    stats['imported'] += len(users) - len(failed)
+    log.info('Imported %s users, %s failed', stats['imported'], len(errors))
+
+
+def _user_from_row(row):
+    '''
+    >>> sorted(_user_from_row({'email': 'foo@bar.com', 'password_hash': 'x',
+    ...                        'google': ''}).items())
+    [('created_ip', ''), ('email', 'foo@bar.com'), ('name', 'foo'), \
+('password', 'x'), ('status', 'active')]
+    '''
+    row = {k: v for k, v in row.items() if v not in (None, '')}
+    email = row.pop('email', '').strip()
+    if '@' not in email:
+        raise ValueError('Wrong email')
+    password = row.pop('password', None)
+    password_hash = row.pop('password_hash', None)
+    if not password and not password_hash:
+        raise ValueError('No password')
+    user = {
+        'email': email,
+        'name': row.pop('name', email.split('@')[0]),
+        'status': row.pop('status', 'active'),
+        'created_ip': row.pop('created_ip', ''),
+    }
+    if user['status'] not in ('confirmation', 'active', 'banned'):
+        raise ValueError('Wrong status')
+    if password_hash:
+        user['password'] = password_hash
+    for provider in ['google', 'facebook', 'vkontakte']:
+        if provider in row:
+            user[provider] = row.pop(provider)
+    return user
+
+
+def _hash_passwords(password_context, passwords):
+    context = CryptContext(**password_context)
+    return [context.hash(password) for password in passwords]
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def read_rows(path, format=None):
+    format = format or os.path.splitext(path)[1].lstrip('.')
+    with open(path, newline='') as f:
+        if format == 'csv':
+            yield from csv.DictReader(f)
+        elif format in ('jsonl', 'json'):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            raise ValueError('Unknown format: {}'.format(format))
+
+
+async def _create_storage(args):
+    if args.dsn:
+        import asyncpg
+        from .asyncpg_storage import AsyncpgStorage
+        pool = await asyncpg.create_pool(dsn=args.dsn)
+        return AsyncpgStorage(pool, user_table_name=args.users)
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from .motor_storage import MotorStorage
+    client = AsyncIOMotorClient(args.mongo)
+    return MotorStorage(client.get_default_database(),
+                        user_coll_name=args.users)
+
+
+async def _main(args):
+    storage = await _create_storage(args)
+    password_context = (json.loads(args.password_context)
+                        if args.password_context else None)
+    errors = []
+    stats = await import_users(
+        storage, read_rows(args.file, args.format),
+        batch_size=args.batch_size, workers=args.workers,
+        password_context=password_context, errors=errors)
+    if args.errors:
+        with open(args.errors, 'w') as f:
+            for error in errors:
+                f.write(json.dumps(error) + '\n')
+    return stats
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Bulk import of users from CSV or JSONL file')
+    parser.add_argument('file')
+    db = parser.add_mutually_exclusive_group(required=True)
+    db.add_argument('--dsn', help='postgres dsn')
+    db.add_argument('--mongo', help='mongodb uri, including the database')
+    parser.add_argument('--format', choices=['csv', 'jsonl'],
+                        help='by default is taken from the file extension')
+    parser.add_argument('--users', default='users',
+                        help='users table or collection name')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--workers', type=int,
+                        help='hashing processes, cpu count by default')
+    parser.add_argument('--password-context',
+                        help='passlib CryptContext settings as json')
+    parser.add_argument('--errors', help='file to write failed rows into')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    loop = asyncio.get_event_loop()
+    stats = loop.run_until_complete(_main(args))
+    json.dump(stats, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    import logging
+    logging.basicConfig(level=logging.INFO)
+    main()
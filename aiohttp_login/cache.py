@@ -0,0 +1,84 @@
+from time import monotonic, time
+from collections import OrderedDict
+
+
+class UserCache:
+    '''In-process LRU cache of users by id with time-based expiration
+
+    >>> cache = UserCache(size=2, ttl=60)
+    >>> cache.set(1, 'foo')
+    >>> cache.set(2, 'bar')
+    >>> cache.get(1)
+    'foo'
+    >>> cache.set(3, 'baz')
+    >>> cache.get(2) is None
+    True
+    >>> cache.invalidate(1)
+    >>> cache.get(1) is None
+    True
+    >>> cache.stats()
+    {'hits': 1, 'misses': 2, 'size': 1}
+
+    A user loaded before its invalidation isn't cached:
+
+    >>> version = cache.invalidated_at(4)
+    >>> cache.invalidate(4)
+    >>> cache.set(4, 'outdated', version)
+    >>> cache.get(4) is None
+    True
+    '''
+
+    def __init__(self, size=10000, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        # user_id -> wall clock time of the last invalidation, used as
+        # a version of the user by session snapshots
+        self.invalidations = OrderedDict()
+        self.cleared_at = 0
+
+    def get(self, user_id):
+        try:
+            expires_at, user = self.entries[user_id]
+        except KeyError:
+            self.misses += 1
+            return None
+        if expires_at < monotonic():
+            del self.entries[user_id]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(user_id)
+        self.hits += 1
+        return user
+
+    def set(self, user_id, user, version=None):
+        '''`version` is `invalidated_at()` taken before loading the user'''
+        if version is not None and version != self.invalidated_at(user_id):
+            return
+        self.entries[user_id] = (monotonic() + self.ttl, user)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self.entries.pop(user_id, None)
+        self.invalidations[user_id] = time()
+        self.invalidations.move_to_end(user_id)
+        while len(self.invalidations) > self.size:
+            self.invalidations.popitem(last=False)
+
+    def invalidated_at(self, user_id):
+        return max(self.invalidations.get(user_id, 0), self.cleared_at)
+
+    def clear(self):
+        self.entries.clear()
+        self.cleared_at = time()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.entries),
+        }
@@ -11,6 +11,17 @@ DEFAULTS = {
     'CSRF_SECRET': REQUIRED,
     'BACK_URL_QS_KEY': 'back_to',
     'SESSION_USER_KEY': 'user',
+    # if set (in seconds), the session also keeps a signed snapshot of the
+    # user (id, status and email), which `login_required` and
+    # `admin_required` trust for this time instead of loading the user.
+    # A change of the user evicts it from the storage `user_cache` and
+    # invalidates the snapshots too
+    'SESSION_USER_SNAPSHOT_TTL': 0,
+    'SESSION_USER_SNAPSHOT_KEY': 'user_snapshot',
+    # fields of the current user loaded on every request, e.g. `('name',)`
+    # (`id`, `status` and `email` are always loaded). None means all the
+    # fields. Use `get_full_user()` to get the rest
+    'SESSION_USER_FIELDS': None,
     'REQUEST_USER_KEY': 'user',
 
     'SESSION_FLASH_KEY': 'flash',
@@ -32,10 +43,49 @@ DEFAULTS = {
     'SMTP_USERNAME': None,
     'SMTP_PASSWORD': None,
 
+    # passlib's CryptContext settings. The first scheme is used for new
+    # hashes. Hashes of deprecated schemes or with costs lower than
+    # `<scheme>__min_rounds` are rewritten on successful login. E.g. to
+    # move to argon2 (needs `argon2_cffi`) set schemes to
+    # `['argon2', 'bcrypt', 'sha256_crypt']`
+    'PASSWORD_CONTEXT': {
+        'schemes': ['sha256_crypt'],
+        'deprecated': 'auto',
+        'sha256_crypt__default_rounds': 1000,
+    },
+    # if set (in seconds, e.g. 0.05), `setup()` benchmarks the default
+    # scheme and picks its rounds to make a password check take about
+    # this time on the current machine
+    'PASSWORD_HASH_TARGET_TIME': None,
+    # where to run password hashing: 'thread' or 'process' pool,
+    # or None to hash right in the event loop
+    'PASSWORD_HASH_EXECUTOR': 'thread',
+    # pool size, None means the executor's default (depends on cpu count)
+    'PASSWORD_HASH_WORKERS': None,
+    # admission control of hashing jobs: max number of jobs running in the
+    # pool (None means the pool size) and max number of jobs waiting for
+    # a free slot. Requests beyond that get 503 with `Retry-After` header
+    'PASSWORD_HASH_MAX_IN_FLIGHT': None,
+    'PASSWORD_HASH_MAX_QUEUE': 100,
+    'PASSWORD_HASH_RETRY_AFTER': 5,
+
     # email confirmation links lifetime in days
     'REGISTRATION_CONFIRMATION_LIFETIME': 5,
     'RESET_PASSWORD_CONFIRMATION_LIFETIME': 5,
     'CHANGE_EMAIL_CONFIRMATION_LIFETIME': 5,
+    # how often (in seconds) expired confirmations are removed in the
+    # background, along with users who never confirmed registration,
+    # e.g. 3600. None disables the cleanup
+    'CLEANUP_INTERVAL': None,
+    # max number of confirmations removed by one statement
+    'CLEANUP_BATCH_SIZE': 1000,
+    # url of prometheus metrics, e.g. '/auth/metrics'. None disables it.
+    # It isn't protected, so restrict the access on a proxy
+    'METRICS_URL': None,
+    # share of requests (from 0 to 1) broken into phases, which are
+    # reported in the `Server-Timing` header and logged by
+    # `aiohttp_login.timing`. 1 times every request (for debugging)
+    'SERVER_TIMING_SAMPLE_RATE': 0,
 
     'MSG_LOGGED_IN': 'You are logged in',
     'MSG_LOGGED_OUT': 'You are logged out',
@@ -0,0 +1,94 @@
+import asyncio
+from contextvars import Context
+
+
+class CoalescingStorage:
+    '''Storage wrapper, which makes concurrent identical reads share one
+    database call
+
+    It's useful when a page fans out into many parallel requests, each of
+    them loading the same current user:
+
+        aiohttp_login.setup(app, CoalescingStorage(AsyncpgStorage(pool)))
+
+    `get_user` and `get_confirmation` are coalesced, everything else goes
+    directly to the wrapped storage. Any write forgets in-flight reads, so
+    a read issued after a write never gets a result started before it.
+
+    The shared call runs in an empty context, so it doesn't use the
+    connection pinned to the request which started it. Reads of a request
+    with a pinned connection aren't coalesced at all, as they should see
+    the request transaction.
+    '''
+    coalesced_methods = ['get_user', 'get_confirmation']
+    write_methods = ['create_user', 'update_user', 'delete_user',
+                     'bulk_create_users', 'create_confirmation',
+                     'delete_confirmation', 'consume_confirmation',
+                     'delete_expired_confirmations']
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.in_flight = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.storage, name)
+        if name in self.coalesced_methods and not self._is_pinned():
+            return lambda filter, *args, **kwargs: self._coalesce(
+                name, filter, args, kwargs)
+        if name in self.write_methods:
+            return lambda *args, **kwargs: self._write(attr, *args, **kwargs)
+        return attr
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+            'in_flight': len(self.in_flight),
+        }
+
+    def _is_pinned(self):
+        current_pin = getattr(self.storage, 'current_pin', None)
+        return current_pin is not None and current_pin.get() is not None
+
+    async def _coalesce(self, method, filter, args, kwargs):
+        key = (method, _freeze(filter), _freeze(args), _freeze(kwargs))
+        future = self.in_flight.get(key)
+        if future is None:
+            self.calls += 1
+            # storages are allowed to modify the filter
+            call = getattr(self.storage, method)(dict(filter), *args,
+                                                 **kwargs)
+            future = Context().run(asyncio.ensure_future, call)
+            self.in_flight[key] = future
+            future.add_done_callback(lambda f: self._forget(key, f))
+        else:
+            self.coalesced += 1
+        # a cancelled request shouldn't cancel the call for the others
+        result = await asyncio.shield(future)
+        # every caller gets its own copy, as from the storage itself
+        return dict(result) if result is not None else None
+
+    def _forget(self, key, future):
+        if self.in_flight.get(key) is future:
+            del self.in_flight[key]
+
+    async def _write(self, method, *args, **kwargs):
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            self.in_flight.clear()
+
+
+def _freeze(value):
+    '''Makes a hashable key of a filter
+
+    >>> _freeze({'user': {'id': 1, 'name': 'foo'}, 'action': 'registration'})
+    (('action', 'registration'), ('user', (('id', 1), ('name', 'foo'))))
+    '''
+    if hasattr(value, 'items'):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
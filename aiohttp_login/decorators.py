@@ -1,4 +1,4 @@
-from functools import wraps
+from functools import wraps, partial
 
 from aiohttp.abc import AbstractView
 from aiohttp.web import HTTPForbidden, json_response, StreamResponse
@@ -8,7 +8,7 @@ except ImportError:
     import json
 
 from .cfg import cfg
-from .utils import url_for, redirect, get_cur_user
+from .utils import url_for, redirect, get_cur_user, LazyUser
 
 
 def _get_request(args):
@@ -18,12 +18,24 @@ def _get_request(args):
     return args[-1]
 
 
-def user_to_request(handler):
-    '''Add user to request if user logged in'''
+def user_to_request(handler=None, *, lazy=False):
+    '''Add user to request if user logged in
+
+    With `@user_to_request(lazy=True)` the request gets an awaitable instead,
+    so the session and the user are loaded only if the handler needs them:
+
+        user = await request['user']
+    '''
+    if handler is None:
+        return partial(user_to_request, lazy=lazy)
+
     @wraps(handler)
     async def decorator(*args):
         request = _get_request(args)
-        request[cfg.REQUEST_USER_KEY] = await get_cur_user(request)
+        if lazy:
+            request[cfg.REQUEST_USER_KEY] = LazyUser(request)
+        else:
+            request[cfg.REQUEST_USER_KEY] = await get_cur_user(request)
         return await handler(*args)
     return decorator
 
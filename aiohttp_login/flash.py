@@ -1,7 +1,7 @@
 from functools import partial
-from aiohttp_session import get_session
 
 from .cfg import cfg
+from .timing import get_session
 
 
 def message(request, message, level='info'):
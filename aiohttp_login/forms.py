@@ -1,12 +1,12 @@
 from functools import lru_cache
 
-from aiohttp_session import get_session
 from wtforms import Form, PasswordField
 from wtforms.fields.html5 import EmailField
 from wtforms.validators import Required, EqualTo, Length, Email
 from wtforms.csrf.session import SessionCSRF
 
 from .cfg import cfg
+from .timing import get_session, phase
 from .utils import is_confirmation_expired
 
 
@@ -22,9 +22,10 @@ def create():
     class BaseForm(Form):
         @classmethod
         async def init(cls, request, *args, **kwargs):
-            session = await get_session(request)
-            kwargs.setdefault('meta', {})['csrf_context'] = session
-            return cls(await request.post(), *args, **kwargs)
+            with phase('form'):
+                session = await get_session(request)
+                kwargs.setdefault('meta', {})['csrf_context'] = session
+                return cls(await request.post(), *args, **kwargs)
 
         class Meta:
             csrf = True
@@ -40,7 +41,8 @@ def create():
                     form=form, filters=filters, **options)
 
         def validate(self):
-            result = super().validate()
+            with phase('form'):
+                result = super().validate()
             if 'csrf_token' in self.errors:
                 for field in self:
                     field.errors.append(self.errors['csrf_token'][0])
@@ -1,25 +1,57 @@
 import logging
+from time import perf_counter
 
-from aiohttp_jinja2 import render_template
-from aiohttp_session import get_session
+from aiohttp.web import Response, HTTPException
+import aiohttp_jinja2
 
 from .cfg import cfg
 from . import forms
 from . import oauth
 from . import flash
+from . import metrics
+from . import timing
+from .timing import get_session
+from .metrics import observed, set_labels
 from .decorators import login_required
-from .utils import (encrypt_password, make_confirmation_link,
-                    check_password, authorize_user, is_confirmation_allowed,
-                    get_random_string, url_for, get_client_ip, redirect,
-                    render_and_send_mail, is_confirmation_expired, themed,
-                    common_themed, social_url)
+from .utils import (async_encrypt_password, make_confirmation_link,
+                    async_check_password, authorize_user,
+                    async_verify_and_update_password,
+                    is_confirmation_allowed, get_random_string, url_for,
+                    get_client_ip, redirect, render_and_send_mail,
+                    is_confirmation_expired, themed, common_themed,
+                    social_url, get_full_user, confirmation_cutoffs)
 
 log = logging.getLogger(__name__)
+render_template = timing.timed('render')(aiohttp_jinja2.render_template)
+
+LOGINS = metrics.registry.histogram(
+    'aiohttp_login_login_seconds', 'Login attempts by outcome',
+    ['outcome'])
+REGISTRATIONS = metrics.registry.histogram(
+    'aiohttp_login_registration_seconds', 'Registrations by outcome',
+    ['outcome'])
+CONFIRMATIONS = metrics.registry.histogram(
+    'aiohttp_login_confirmation_seconds', 'Confirmation link clicks',
+    ['action', 'outcome'])
+OAUTH_CALLS = metrics.registry.histogram(
+    'aiohttp_login_oauth_seconds', 'OAuth provider calls',
+    ['provider', 'outcome'])
 
 
 async def social(request):
     provider = request.match_info['provider']
-    data = await getattr(oauth, provider)(request)
+    started = perf_counter()
+    outcome = 'error'
+    try:
+        data = await getattr(oauth, provider)(request)
+        outcome = 'success' if 'user_id' in data else 'failure'
+    except HTTPException:
+        # the first step redirects to the provider
+        outcome = 'redirect'
+        raise
+    finally:
+        OAUTH_CALLS.observe(perf_counter() - started, provider=provider,
+                            outcome=outcome)
     db = cfg.STORAGE
 
     user = None
@@ -41,7 +73,7 @@ async def social(request):
             user = await db.create_user({
                 'name': data['name'],
                 'email': data['email'],
-                'password': encrypt_password(password),
+                'password': await async_encrypt_password(password),
                 'status': 'active',
                 'created_ip': get_client_ip(request),
                 provider: data['user_id'],
@@ -63,6 +95,7 @@ async def social(request):
     return redirect('auth_login')
 
 
+@observed(REGISTRATIONS)
 async def registration(request):
     form = await forms.get('Registration').init(request)
     db = cfg.STORAGE
@@ -72,13 +105,14 @@ async def registration(request):
         user = await db.create_user({
             'name': form.email.data.split('@')[0],
             'email': form.email.data,
-            'password': encrypt_password(form.password.data),
+            'password': await async_encrypt_password(form.password.data),
             'status': ('confirmation' if cfg.REGISTRATION_CONFIRMATION_REQUIRED
                        else 'active'),
             'created_ip': get_client_ip(request),
         })
 
         if not cfg.REGISTRATION_CONFIRMATION_REQUIRED:
+            set_labels(request, outcome='registered')
             await authorize_user(request, user)
             flash.success(request, cfg.MSG_LOGGED_IN)
             return redirect(cfg.LOGIN_REDIRECT)
@@ -100,8 +134,10 @@ async def registration(request):
             form.email.errors.append(cfg.MSG_CANT_SEND_MAIL)
             await db.delete_confirmation(confirmation)
             await db.delete_user(user)
+            set_labels(request, outcome='mail_failed')
             break
 
+        set_labels(request, outcome='confirmation_sent')
         return redirect('auth_registration_requested')
 
     return render_template(themed('registration.html'), request, {
@@ -114,6 +150,7 @@ async def registration(request):
     })
 
 
+@observed(LOGINS)
 async def login(request):
     form = await forms.get('Login').init(request)
 
@@ -121,21 +158,31 @@ async def login(request):
 
         user = await cfg.STORAGE.get_user({'email': form.email.data})
         if not user:
+            set_labels(request, outcome='unknown_email')
             form.email.errors.append(cfg.MSG_UNKNOWN_EMAIL)
             break
 
-        if not check_password(form.password.data, user['password']):
+        is_valid, new_hash = await async_verify_and_update_password(
+            form.password.data, user['password'])
+        if not is_valid:
+            set_labels(request, outcome='wrong_password')
             form.password.errors.append(cfg.MSG_WRONG_PASSWORD)
             break
 
         if user['status'] == 'banned':
+            set_labels(request, outcome='banned')
             form.email.errors.append(cfg.MSG_USER_BANNED)
             break
         if user['status'] == 'confirmation':
+            set_labels(request, outcome='needs_activation')
             form.email.errors.append(cfg.MSG_ACTIVATION_REQUIRED)
             break
         assert user['status'] == 'active'
 
+        if new_hash:
+            # rehash with the current scheme and costs
+            await cfg.STORAGE.update_user(user, {'password': new_hash})
+        set_labels(request, outcome='success')
         await authorize_user(request, user)
         flash.success(request, cfg.MSG_LOGGED_IN)
         url = request.query.get(cfg.BACK_URL_QS_KEY, cfg.LOGIN_REDIRECT)
@@ -154,6 +201,7 @@ async def login(request):
 async def logout(request):
     session = await get_session(request)
     session.pop(cfg.SESSION_USER_KEY, None)
+    session.pop(cfg.SESSION_USER_SNAPSHOT_KEY, None)
     flash.info(request, cfg.MSG_LOGGED_OUT)
     return redirect(cfg.LOGOUT_REDIRECT)
 
@@ -216,8 +264,9 @@ async def reset_password_allowed(request, confirmation):
     assert user
 
     while request.method == 'POST' and form.validate():
-        await db.update_user(
-            user, {'password': encrypt_password(form.password.data)})
+        set_labels(request, action='reset_password', outcome='success')
+        password = await async_encrypt_password(form.password.data)
+        await db.update_user(user, {'password': password})
         await db.delete_confirmation(confirmation)
         await authorize_user(request, user)
         flash.success(request, cfg.MSG_PASSWORD_CHANGED)
@@ -236,16 +285,12 @@ async def reset_password_allowed(request, confirmation):
 @login_required
 async def change_email(request):
     db = cfg.STORAGE
-    user = request[cfg.REQUEST_USER_KEY]
+    user = await get_full_user(request)
     form = await forms.get('ChangeEmail').init(
         request, email=user['email'])
 
     while request.method == 'POST' and form.validate(user['email']):
-        confirmation = await db.get_confirmation(
-            {'user': user, 'action': 'change_email'})
-        if confirmation:
-            await db.delete_confirmation(confirmation)
-
+        # replaces the previous request if any
         confirmation = await db.create_confirmation(
             user, 'change_email', form.email.data)
         link = await make_confirmation_link(request, confirmation)
@@ -279,15 +324,16 @@ async def change_email(request):
 @login_required
 async def change_password(request):
     db = cfg.STORAGE
-    user = request[cfg.REQUEST_USER_KEY]
+    user = await get_full_user(request)
     form = await forms.get('ChangePassword').init(request)
 
     while request.method == 'POST' and form.validate():
-        if not check_password(form.cur_password.data, user['password']):
+        if not await async_check_password(form.cur_password.data,
+                                          user['password']):
             form.cur_password.errors.append(cfg.MSG_WRONG_PASSWORD)
             break
 
-        password = encrypt_password(form.new_password.data)
+        password = await async_encrypt_password(form.new_password.data)
         await db.update_user(user, {'password': password})
 
         flash.success(request, cfg.MSG_PASSWORD_CHANGED)
@@ -302,37 +348,41 @@ async def change_password(request):
     })
 
 
+@observed(CONFIRMATIONS)
 async def confirmation(request):
     db = cfg.STORAGE
     code = request.match_info['code']
 
-    confirmation = await db.get_confirmation({'code': code})
-    if confirmation and is_confirmation_expired(confirmation):
-        await db.delete_confirmation(confirmation)
-        confirmation = None
+    # registration and email changing are applied by the storage at once,
+    # only one of concurrent clicks gets the confirmation
+    confirmation, user = await db.consume_confirmation(
+        code, confirmation_cutoffs(['registration', 'change_email']))
 
     if confirmation:
         action = confirmation['action']
+        set_labels(request, action=action, outcome='success')
 
         if action == 'registration':
-            user = await db.get_user({'id': confirmation['user_id']})
-            await db.update_user(user, {'status': 'active'})
             await authorize_user(request, user)
-            await db.delete_confirmation(confirmation)
             flash.success(request, cfg.MSG_ACTIVATED)
             flash.success(request, cfg.MSG_LOGGED_IN)
             return redirect(cfg.LOGIN_REDIRECT)
 
-        if action == 'reset_password':
-            return await reset_password_allowed(request, confirmation)
-
         if action == 'change_email':
-            user = await db.get_user({'id': confirmation['user_id']})
-            await db.update_user(user, {'email': confirmation['data']})
-            await db.delete_confirmation(confirmation)
             flash.success(request, cfg.MSG_EMAIL_CHANGED)
             return redirect('auth_change_email')
 
+    # password resetting is confirmed by the form, also here we clean up
+    # expired confirmations
+    confirmation = await db.get_confirmation({'code': code})
+    if confirmation and is_confirmation_expired(confirmation):
+        await db.delete_confirmation(confirmation)
+        confirmation = None
+
+    if confirmation and confirmation['action'] == 'reset_password':
+        return await reset_password_allowed(request, confirmation)
+
+    set_labels(request, action='', outcome='wrong_or_expired')
     return render_template(themed('confirmation_error.html'), request, {
         'auth': {
             'cfg': cfg
@@ -340,6 +390,11 @@ async def confirmation(request):
     })
 
 
+async def metrics_handler(request):
+    return Response(text=metrics.render(), headers={
+        'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
 def template_handler(template, context=None):
     async def handler(request):
         return render_template(themed(template), request, context)
@@ -0,0 +1,129 @@
+from time import perf_counter
+from contextvars import ContextVar
+
+from . import metrics
+
+
+# (histogram, labels) of the timed storage call, which observes waits for
+# pool connections
+_pool_wait = ContextVar('aiohttp_login_pool_wait', default=None)
+
+
+class InstrumentedStorage:
+    '''Storage wrapper, which times every storage call
+
+        storage = InstrumentedStorage(AsyncpgStorage(pool))
+        aiohttp_login.setup(app, storage, {...})
+
+    Calls are recorded into `aiohttp_login.metrics.registry` labeled by
+    method and filter shape (e.g. `get_user` by `id` or by `email`):
+
+    - `aiohttp_login_storage_call_seconds` histogram
+    - `aiohttp_login_storage_errors_total` counter, also labeled by error
+    - `aiohttp_login_storage_pool_wait_seconds` histogram of connection
+      acquiring, also labeled by pool (`primary`, `replica` or `index` of
+      `ShardedStorage`), for
+      storages acquiring connections with `instrumentation.acquire()`
+
+    It can wrap other wrappers, e.g. `CoalescingStorage`, then only calls
+    reaching the database are timed for the pool wait.
+    '''
+    timed_methods = [
+        'get_user', 'create_user', 'bulk_create_users', 'update_user',
+        'delete_user', 'create_confirmation', 'get_confirmation',
+        'delete_confirmation', 'consume_confirmation',
+        'delete_expired_confirmations',
+    ]
+
+    def __init__(self, storage, registry=None):
+        registry = registry or metrics.registry
+        self.storage = storage
+        self.calls = registry.histogram(
+            'aiohttp_login_storage_call_seconds',
+            'Latency of storage calls', ['method', 'filter'])
+        self.errors = registry.counter(
+            'aiohttp_login_storage_errors_total',
+            'Failed storage calls', ['method', 'filter', 'error'])
+        self.pool_wait = registry.histogram(
+            'aiohttp_login_storage_pool_wait_seconds',
+            'Time of waiting for a pool connection',
+            ['method', 'filter', 'pool'])
+
+    def __getattr__(self, name):
+        attr = getattr(self.storage, name)
+        if name in self.timed_methods:
+            return lambda *args, **kwargs: self._timed(
+                name, attr, args, kwargs)
+        return attr
+
+    async def _timed(self, name, method, args, kwargs):
+        shape = ''
+        if name.startswith('get_'):
+            shape = filter_shape(args[0] if args else kwargs.get('filter', {}))
+        token = _pool_wait.set(
+            (self.pool_wait, {'method': name, 'filter': shape}))
+        started = perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        except Exception as e:
+            self.errors.inc(method=name, filter=shape,
+                            error=type(e).__name__)
+            raise
+        finally:
+            self.calls.observe(perf_counter() - started,
+                               method=name, filter=shape)
+            _pool_wait.reset(token)
+
+
+def filter_shape(filter):
+    '''Label of a filter, which doesn't depend on the values
+
+    >>> filter_shape({'email': 'foo@bar.com'})
+    'email'
+    >>> filter_shape({'user': {'id': 1}, 'action': 'registration'})
+    'action,user'
+    '''
+    return ','.join(sorted(filter))
+
+
+def acquire(pool, name):
+    '''`pool.acquire()`, which observes the wait into the pool wait
+    histogram of the storage call timed by `InstrumentedStorage`
+    '''
+    pool_wait = _pool_wait.get()
+    if pool_wait is None:
+        return pool.acquire()
+    return _TimedAcquire(pool.acquire(), pool_wait, name)
+
+
+class _TimedAcquire:
+    '''Supports both `async with pool.acquire()` and `await pool.acquire()`
+    '''
+    def __init__(self, acquire, pool_wait, name):
+        self.acquire = acquire
+        self.histogram, self.labels = pool_wait
+        self.name = name
+
+    async def __aenter__(self):
+        started = perf_counter()
+        try:
+            return await self.acquire.__aenter__()
+        finally:
+            self._observe(started)
+
+    def __aexit__(self, *args):
+        return self.acquire.__aexit__(*args)
+
+    def __await__(self):
+        return self._acquire().__await__()
+
+    async def _acquire(self):
+        started = perf_counter()
+        try:
+            return await self.acquire
+        finally:
+            self._observe(started)
+
+    def _observe(self, started):
+        self.histogram.observe(perf_counter() - started, pool=self.name,
+                               **self.labels)
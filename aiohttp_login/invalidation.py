@@ -0,0 +1,146 @@
+'''
+Buses to evict changed users from caches of all the app nodes.
+
+Storages publish string ids (`user_session_id`) of changed users and
+receive ids published by other nodes:
+
+    bus = PgInvalidationBus(pool)
+    storage = AsyncpgStorage(pool, user_cache=UserCache(),
+                             invalidation_bus=bus)
+'''
+import asyncio
+from logging import getLogger
+
+
+log = getLogger(__name__)
+
+
+class LocalInvalidationBus:
+    '''In-process bus. Enough for a single node, also it can be shared by
+    a few storages to emulate a cluster in tests
+    '''
+    def __init__(self):
+        self.subscribers = []
+        self.reset_subscribers = []
+
+    def subscribe(self, callback, on_reset=None):
+        '''`callback(user_id)` is called for every published id and
+        `on_reset()` if some ids could be missed, e.g. while the bus was
+        reconnecting
+        '''
+        self.subscribers.append(callback)
+        if on_reset:
+            self.reset_subscribers.append(on_reset)
+
+    async def publish(self, user_id, conn=None):
+        self.deliver(user_id)
+
+    def deliver(self, user_id):
+        for callback in self.subscribers:
+            try:
+                callback(user_id)
+            except Exception as e:
+                log.error('Invalidation callback failed', exc_info=e)
+
+    def reset(self):
+        for callback in self.reset_subscribers:
+            try:
+                callback()
+            except Exception as e:
+                log.error('Invalidation reset callback failed', exc_info=e)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+
+class PgInvalidationBus(LocalInvalidationBus):
+    '''Bus on top of postgres LISTEN / NOTIFY. It holds one connection of
+    the pool for listening, which also sends notifications of writes made
+    without a connection at hand. Notifications sent inside a transaction
+    are delivered after commit.
+
+    If the listening connection is lost, the bus listens on a new one and
+    resets subscribers, as notifications sent meanwhile are lost.
+    '''
+    def __init__(self, pool, channel='aiohttp_login_users',
+                 reconnect_delay=1):
+        super().__init__()
+        self.pool = pool
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self.conn = None
+        self.lock = asyncio.Lock()
+        self.reconnecting = None
+        self.stopped = True
+
+    async def publish(self, user_id, conn=None):
+        if conn is not None:
+            return await self._notify(conn, user_id)
+        async with self.lock:
+            if self.conn is not None and not self.conn.is_closed():
+                return await self._notify(self.conn, user_id)
+        async with self.pool.acquire() as conn:
+            await self._notify(conn, user_id)
+
+    def _notify(self, conn, user_id):
+        return conn.execute('SELECT pg_notify($1, $2)', self.channel, user_id)
+
+    async def start(self):
+        self.stopped = False
+        await self._listen()
+
+    async def _listen(self):
+        conn = await self.pool.acquire()
+        try:
+            await conn.add_listener(self.channel, self._on_notify)
+        except BaseException:
+            await self.pool.release(conn)
+            raise
+        conn.add_termination_listener(self._on_termination)
+        self.conn = conn
+
+    def _on_termination(self, conn):
+        if self.stopped or conn is not self.conn:
+            return
+        log.warning('Invalidation listener connection is lost')
+        self.conn = None
+        self.reconnecting = asyncio.ensure_future(self._reconnect(conn))
+
+    async def _reconnect(self, lost):
+        try:
+            await self.pool.release(lost)
+        except Exception as e:
+            log.debug('Lost connection release failed', exc_info=e)
+        while not self.stopped:
+            try:
+                await self._listen()
+            except Exception as e:
+                log.error('Can not listen for invalidations', exc_info=e)
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+            self.reset()
+            return
+
+    async def stop(self):
+        self.stopped = True
+        if self.reconnecting is not None:
+            self.reconnecting.cancel()
+            try:
+                await self.reconnecting
+            except asyncio.CancelledError:
+                pass
+            self.reconnecting = None
+        conn, self.conn = self.conn, None
+        if conn is None:
+            return
+        try:
+            conn.remove_termination_listener(self._on_termination)
+            await conn.remove_listener(self.channel, self._on_notify)
+        finally:
+            await self.pool.release(conn)
+
+    def _on_notify(self, conn, pid, channel, payload):
+        self.deliver(payload)
@@ -0,0 +1,283 @@
+'''
+Storage keeping everything in process memory.
+
+It's useful for tests, for load testing of the auth layer without
+a database and as a reference implementation of the storage interface:
+
+    storage = InMemoryStorage()
+    aiohttp_login.setup(app, storage, {...})
+
+Users and confirmations are kept as dicts, looked up by the same unique
+keys the database backends have indexes on: user id, email (case
+insensitive), social ids and confirmation code. Confirmations reference
+their users as foreign keys of the sql backends do: a user with
+confirmations can't be deleted. Returned records are copies, as they would
+be if loaded from a database.
+'''
+from itertools import count
+from datetime import datetime
+from logging import getLogger
+
+from .utils import get_random_string
+
+
+log = getLogger(__name__)
+SOCIAL_PROVIDERS = ['google', 'facebook', 'vkontakte']
+ACTIONS = ['registration', 'reset_password', 'change_email']
+
+
+class DuplicateKeyError(ValueError):
+    pass
+
+
+class ForeignKeyError(ValueError):
+    pass
+
+
+class InMemoryStorage:
+    def __init__(self, *, user_cache=None, invalidation_bus=None):
+        self.user_cache = user_cache
+        self.invalidation_bus = invalidation_bus
+        if invalidation_bus:
+            invalidation_bus.subscribe(self._on_invalidation,
+                                       self._on_invalidation_reset)
+        self.next_user_id = count(1).__next__
+        self.users = {}
+        # unique key -> user id
+        self.users_by_email = {}
+        self.users_by_social = {provider: {}
+                                for provider in SOCIAL_PROVIDERS}
+        self.confirmations = {}
+        # (user_id, action) -> code
+        self.confirmations_by_user = {}
+
+    async def get_user(self, filter, fields=None):
+        user = self._find_user(filter)
+        if user is None:
+            return None
+        if fields:
+            return {field: user.get(field) for field in fields}
+        return dict(user)
+
+    async def create_user(self, data):
+        data.setdefault('created_at', datetime.utcnow())
+        self._check_unique(data)
+        data['id'] = self.next_user_id()
+        self._insert_user(dict(data))
+        return data
+
+    async def bulk_create_users(self, users):
+        errors = []
+        for index, user in enumerate(users):
+            try:
+                await self.create_user(user)
+            except DuplicateKeyError as e:
+                errors.append((index, str(e)))
+        return errors
+
+    async def update_user(self, user, updates):
+        stored = self.users.get(user['id'])
+        if stored is None:
+            return
+        changed = dict(stored, **updates)
+        self._check_unique(changed, stored['id'])
+        self._remove_user(stored)
+        self._insert_user(changed)
+        await self.invalidate_user(user)
+
+    async def delete_user(self, user):
+        stored = self.users.get(user['id'])
+        if stored is None:
+            return
+        if self._has_confirmations(stored['id']):
+            raise ForeignKeyError('confirmations.user_id')
+        self._remove_user(stored)
+        await self.invalidate_user(user)
+
+    async def invalidate_user(self, user):
+        if self.user_cache:
+            self.user_cache.invalidate(user['id'])
+        if self.invalidation_bus:
+            await self.invalidation_bus.publish(self.user_session_id(user))
+
+    def _on_invalidation(self, id_str):
+        user_id = self.user_id_from_string(id_str)
+        if self.user_cache and user_id:
+            self.user_cache.invalidate(user_id)
+
+    def _on_invalidation_reset(self):
+        if self.user_cache:
+            self.user_cache.clear()
+
+    async def on_startup(self, app):
+        if self.invalidation_bus:
+            await self.invalidation_bus.start()
+
+    async def on_cleanup(self, app):
+        if self.invalidation_bus:
+            await self.invalidation_bus.stop()
+
+    async def create_confirmation(self, user, action, data=None):
+        '''Creates a confirmation, replacing the previous one of the same
+        user and action
+        '''
+        if user['id'] not in self.users:
+            raise ForeignKeyError('confirmations.user_id')
+        code = get_random_string(30)
+        while code in self.confirmations:
+            code = get_random_string(30)
+        confirmation = {
+            'code': code,
+            'user_id': user['id'],
+            'action': action,
+            'data': data,
+            'created_at': datetime.utcnow(),
+        }
+        previous = self.confirmations_by_user.get((user['id'], action))
+        if previous:
+            self._remove_confirmation(self.confirmations[previous])
+        self.confirmations[code] = confirmation
+        self.confirmations_by_user[(user['id'], action)] = code
+        return dict(confirmation)
+
+    async def get_confirmation(self, filter):
+        if 'user' in filter:
+            filter['user_id'] = filter.pop('user')['id']
+        if 'code' in filter:
+            candidates = [self.confirmations.get(filter['code'])]
+        elif 'user_id' in filter and 'action' in filter:
+            code = self.confirmations_by_user.get(
+                (filter['user_id'], filter['action']))
+            candidates = [self.confirmations.get(code)]
+        else:
+            candidates = self.confirmations.values()
+        for confirmation in candidates:
+            if confirmation and _matches(confirmation, filter):
+                return dict(confirmation)
+
+    async def delete_confirmation(self, confirmation):
+        stored = self.confirmations.get(confirmation['code'])
+        if stored:
+            self._remove_confirmation(stored)
+
+    async def consume_confirmation(self, code, min_created_at):
+        '''Deletes not expired confirmation and applies it to the user:
+        activates registration or changes email.
+
+        `min_created_at` is `{action: datetime}`, other actions are ignored.
+        Returns `(confirmation, user)` or `(None, None)`.
+        '''
+        confirmation = self.confirmations.get(code)
+        if (not confirmation or
+                confirmation['action'] not in min_created_at or
+                confirmation['created_at'] <=
+                min_created_at[confirmation['action']]):
+            return None, None
+        self._remove_confirmation(confirmation)
+        user = self.users.get(confirmation['user_id'])
+        if user is None:
+            return None, None
+        if confirmation['action'] == 'registration':
+            await self.update_user(user, {'status': 'active'})
+        elif confirmation['action'] == 'change_email':
+            await self.update_user(user, {'email': confirmation['data']})
+        return confirmation, dict(self.users[user['id']])
+
+    async def delete_expired_confirmations(self, min_created_at, limit):
+        '''Deletes up to `limit` confirmations created before
+        `min_created_at` (`{action: datetime}`) and users who didn't confirm
+        their registration. Returns the number of deleted confirmations and
+        ids of deleted users.
+        '''
+        expired = [c for c in self.confirmations.values()
+                   if c['action'] in min_created_at and
+                   c['created_at'] < min_created_at[c['action']]][:limit]
+        for confirmation in expired:
+            self._remove_confirmation(confirmation)
+        user_ids = []
+        for confirmation in expired:
+            user = self.users.get(confirmation['user_id'])
+            if (confirmation['action'] == 'registration' and user and
+                    user['status'] == 'confirmation' and
+                    not self._has_confirmations(user['id'])):
+                await self.delete_user(user)
+                user_ids.append(user['id'])
+        return len(expired), user_ids
+
+    def user_id_from_string(self, id_str):
+        try:
+            return int(id_str)
+        except ValueError as ex:
+            log.error('Can\'t convert string into id', exc_info=ex)
+
+    def user_session_id(self, user):
+        return str(user['id'])
+
+    def _has_confirmations(self, user_id):
+        return any(self.confirmations_by_user.get((user_id, action))
+                   for action in ACTIONS)
+
+    def _find_user(self, filter):
+        if 'id' in filter:
+            candidates = [self.users.get(filter['id'])]
+        elif 'email' in filter:
+            candidates = [self.users.get(
+                self.users_by_email.get(filter['email'].lower()))]
+        else:
+            for provider in SOCIAL_PROVIDERS:
+                if provider in filter:
+                    candidates = [self.users.get(
+                        self.users_by_social[provider].get(filter[provider]))]
+                    break
+            else:
+                candidates = self.users.values()
+        for user in candidates:
+            if user and _matches(user, filter):
+                return user
+
+    def _check_unique(self, user, user_id=None):
+        email_owner = self.users_by_email.get(user['email'].lower())
+        if email_owner not in (None, user_id):
+            raise DuplicateKeyError(
+                'Email is already taken: {}'.format(user['email']))
+        for provider in SOCIAL_PROVIDERS:
+            owner = self.users_by_social[provider].get(user.get(provider))
+            if owner not in (None, user_id):
+                raise DuplicateKeyError(
+                    '{} id is already taken: {}'.format(
+                        provider, user[provider]))
+
+    def _insert_user(self, user):
+        self.users[user['id']] = user
+        self.users_by_email[user['email'].lower()] = user['id']
+        for provider in SOCIAL_PROVIDERS:
+            if user.get(provider) is not None:
+                self.users_by_social[provider][user[provider]] = user['id']
+
+    def _remove_user(self, user):
+        del self.users[user['id']]
+        del self.users_by_email[user['email'].lower()]
+        for provider in SOCIAL_PROVIDERS:
+            if user.get(provider) is not None:
+                del self.users_by_social[provider][user[provider]]
+
+    def _remove_confirmation(self, confirmation):
+        del self.confirmations[confirmation['code']]
+        del self.confirmations_by_user[
+            (confirmation['user_id'], confirmation['action'])]
+
+
+def _matches(record, filter):
+    '''
+    >>> _matches({'email': 'Foo@Bar', 'id': 1}, {'email': 'foo@bar'})
+    True
+    >>> _matches({'id': 1, 'status': 'active'}, {'id': 1, 'status': 'banned'})
+    False
+    '''
+    for key, value in filter.items():
+        stored = record.get(key)
+        if key == 'email' and stored and value:
+            stored, value = stored.lower(), value.lower()
+        if stored != value:
+            return False
+    return True
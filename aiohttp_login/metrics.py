@@ -0,0 +1,219 @@
+'''
+In-process metrics registry.
+
+Metrics of the package are kept in the global `registry`, any exporter can
+read them with `registry.collect()`:
+
+    for metric in registry.collect():
+        print(metric.name, metric.type, metric.samples())
+
+>>> registry = Registry()
+>>> calls = registry.counter('calls_total', 'Calls', ['method'])
+>>> calls.inc(method='get_user')
+>>> calls.inc(2, method='get_user')
+>>> calls.samples()
+{('get_user',): 3}
+>>> latency = registry.histogram('latency_seconds', 'Latency', ['method'],
+...                              buckets=[0.1, 1])
+>>> latency.observe(0.05, method='get_user')
+>>> latency.observe(0.5, method='get_user')
+>>> latency.samples()[('get_user',)]
+{'buckets': [1, 2, 2], 'sum': 0.55, 'count': 2}
+>>> [m.name for m in registry.collect()]
+['calls_total', 'latency_seconds']
+>>> print(render(registry))
+# HELP calls_total Calls
+# TYPE calls_total counter
+calls_total{method="get_user"} 3
+# HELP latency_seconds Latency
+# TYPE latency_seconds histogram
+latency_seconds_bucket{method="get_user",le="0.1"} 1
+latency_seconds_bucket{method="get_user",le="1"} 2
+latency_seconds_bucket{method="get_user",le="+Inf"} 2
+latency_seconds_sum{method="get_user"} 0.55
+latency_seconds_count{method="get_user"} 2
+<BLANKLINE>
+'''
+from bisect import bisect_left
+from functools import wraps
+from time import perf_counter
+
+
+LABELS_KEY = 'aiohttp_login_metrics_labels'
+DEFAULT_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10]
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def samples(self):
+        '''Returns `{label_values: value}`'''
+        return dict(self.values)
+
+    def clear(self):
+        self.values.clear()
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    '''Cumulative histogram: every bucket counts observations less than or
+    equal to its upper bound, the last one (+Inf) counts all of them
+    '''
+    type = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=None):
+        super().__init__(name, description, labels)
+        self.buckets = sorted(buckets or DEFAULT_BUCKETS)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        try:
+            counts, total = self.values[key]
+        except KeyError:
+            counts, total = [0] * (len(self.buckets) + 1), 0
+        counts[bisect_left(self.buckets, value)] += 1
+        self.values[key] = (counts, total + value)
+
+    def time(self, **labels):
+        '''Observes the execution time of a block:
+
+            with histogram.time(method='get_user'):
+                ...
+        '''
+        return _Timer(self, labels)
+
+    def samples(self):
+        samples = {}
+        for key, (counts, total) in self.values.items():
+            cumulative, count = [], 0
+            for bucket_count in counts:
+                count += bucket_count
+                cumulative.append(count)
+            samples[key] = {'buckets': cumulative, 'sum': round(total, 9),
+                            'count': count}
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name, description, labels=()):
+        return self._get_or_create(Counter, name, description, labels)
+
+    def histogram(self, name, description, labels=(), buckets=None):
+        return self._get_or_create(Histogram, name, description, labels,
+                                   buckets=buckets)
+
+    def collect(self):
+        return list(self.metrics.values())
+
+    def clear(self):
+        for metric in self.metrics.values():
+            metric.clear()
+
+    def _get_or_create(self, cls, name, description, labels, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, description, labels,
+                                              **kwargs)
+        elif not isinstance(metric, cls) or metric.labels != tuple(labels):
+            raise ValueError(
+                'Metric {} is already registered differently'.format(name))
+        return metric
+
+
+registry = Registry()
+
+
+def render(registry=registry):
+    '''Renders metrics in prometheus text format'''
+    lines = []
+    for metric in registry.collect():
+        lines.append('# HELP {} {}'.format(metric.name, metric.description))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+        for key, value in sorted(metric.samples().items()):
+            labels = list(zip(metric.labels, key))
+            if metric.type != 'histogram':
+                lines.append(_sample(metric.name, labels, value))
+                continue
+            bounds = [_number(b) for b in metric.buckets] + ['+Inf']
+            for bound, count in zip(bounds, value['buckets']):
+                lines.append(_sample(metric.name + '_bucket',
+                                     labels + [('le', bound)], count))
+            lines.append(_sample(metric.name + '_sum', labels, value['sum']))
+            lines.append(_sample(metric.name + '_count', labels,
+                                 value['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def _sample(name, labels, value):
+    '''
+    >>> _sample('foo', [('a', 'x"y')], 1.5)
+    'foo{a="x\\\\"y"} 1.5'
+    '''
+    if labels:
+        name += '{' + ','.join('{}="{}"'.format(k, _escape(v))
+                               for k, v in labels) + '}'
+    return '{} {}'.format(name, _number(value))
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _number(value):
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def observed(histogram):
+    '''Handler decorator, which observes the handler time with labels set
+    by the handler via `set_labels()`. Requests without labels (e.g. form
+    rendering) aren't observed.
+    '''
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(request):
+            started = perf_counter()
+            try:
+                return await handler(request)
+            finally:
+                labels = request.get(LABELS_KEY)
+                if labels:
+                    histogram.observe(perf_counter() - started, **labels)
+        return wrapper
+    return decorator
+
+
+def set_labels(request, **labels):
+    request[LABELS_KEY] = labels
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = perf_counter()
+
+    def __exit__(self, *args):
+        self.histogram.observe(perf_counter() - self.started, **self.labels)
@@ -3,51 +3,157 @@ from datetime import datetime
 
 from bson.objectid import ObjectId
 from bson.errors import InvalidId
+from pymongo import ReturnDocument, ASCENDING
+from pymongo.collation import Collation
+from pymongo.errors import (DuplicateKeyError, BulkWriteError,
+                            OperationFailure)
 
-from .utils import get_random_string, get_client_ip
+from .utils import get_random_string, confirmation_lifetime
 
 
 log = getLogger(__name__)
+# case insensitive comparison, the same as postgres citext
+EMAIL_COLLATION = Collation('en', strength=2)
+SOCIAL_PROVIDERS = ['google', 'facebook', 'vkontakte']
+CONFIRMATION_ACTIONS = ['registration', 'reset_password', 'change_email']
 
 
 class MotorStorage:
     def __init__(self, db, *,
                  user_coll_name='users',
-                 confirmation_coll_name='confirmations'):
+                 confirmation_coll_name='confirmations',
+                 user_cache=None,
+                 invalidation_bus=None,
+                 ensure_indexes=False):
+        self.db = db
+        self.ensure_indexes_on_startup = ensure_indexes
         self.users = db[user_coll_name]
         self.confirmations = db[confirmation_coll_name]
+        self.user_cache = user_cache
+        self.invalidation_bus = invalidation_bus
+        if invalidation_bus:
+            invalidation_bus.subscribe(self._on_invalidation,
+                                       self._on_invalidation_reset)
 
-    async def get_user(self, filter):
+    async def get_user(self, filter, fields=None):
         if 'id' in filter:
             filter['_id'] = filter.pop('id')
-        return await self.users.find_one(filter)
+        # `_id` is always returned
+        projection = fields and {f: 1 for f in fields if f != 'id'}
+        if 'email' in filter:
+            # uses the case insensitive index
+            user = await self.users.find_one(filter, projection,
+                                             collation=EMAIL_COLLATION)
+        else:
+            user = await self.users.find_one(filter, projection)
+        if user and fields and 'id' in fields:
+            user['id'] = user['_id']
+        return user
 
     async def create_user(self, data):
         data.setdefault('created_at', datetime.utcnow())
         data['_id'] = await self.users.insert(data)
         return data
 
-    def update_user(self, user, updates):
-        return self.users.update({'_id': user['_id']}, {'$set': updates})
-
-    def delete_user(self, user):
-        return self.users.remove({'_id': user['_id']})
+    async def bulk_create_users(self, users):
+        '''Inserts users in one request, returns `[(index, error), ...]` of
+        not inserted ones
+        '''
+        now = datetime.utcnow()
+        for user in users:
+            user.setdefault('created_at', now)
+        try:
+            await self.users.insert_many(users, ordered=False)
+        except BulkWriteError as e:
+            return [(error['index'], error['errmsg'])
+                    for error in e.details['writeErrors']]
+        return []
+
+    async def update_user(self, user, updates):
+        await self.users.update({'_id': user['_id']}, {'$set': updates})
+        await self.invalidate_user(user)
+
+    async def delete_user(self, user):
+        await self.users.remove({'_id': user['_id']})
+        await self.invalidate_user(user)
+
+    async def invalidate_user(self, user):
+        if self.user_cache:
+            self.user_cache.invalidate(user['_id'])
+        if self.invalidation_bus:
+            await self.invalidation_bus.publish(self.user_session_id(user))
+
+    def _on_invalidation(self, id_str):
+        user_id = self.user_id_from_string(id_str)
+        if self.user_cache and user_id:
+            self.user_cache.invalidate(user_id)
+
+    def _on_invalidation_reset(self):
+        if self.user_cache:
+            self.user_cache.clear()
+
+    async def on_startup(self, app):
+        if self.invalidation_bus:
+            await self.invalidation_bus.start()
+        if self.ensure_indexes_on_startup:
+            await self.ensure_indexes()
+
+    async def ensure_indexes(self):
+        '''Creates indexes of all the lookups. Confirmations are removed by
+        mongo itself when the longest of `*_CONFIRMATION_LIFETIME` passes.
+        '''
+        await self.users.create_index('email', unique=True,
+                                      collation=EMAIL_COLLATION)
+        for provider in SOCIAL_PROVIDERS:
+            await self.users.create_index(provider, unique=True, sparse=True)
+        await self.users.create_index(
+            [('status', ASCENDING), ('created_at', ASCENDING)])
+        await self.confirmations.create_index('code', unique=True)
+        await self.confirmations.create_index(
+            [('user_id', ASCENDING), ('action', ASCENDING)], unique=True)
+        await self._ensure_ttl_index(int(max(
+            confirmation_lifetime(action).total_seconds()
+            for action in CONFIRMATION_ACTIONS)))
+
+    async def _ensure_ttl_index(self, expire_after):
+        try:
+            await self.confirmations.create_index(
+                'created_at', expireAfterSeconds=expire_after)
+        except OperationFailure:
+            # the index exists with another lifetime
+            log.info('Changing confirmations lifetime to %s seconds',
+                     expire_after)
+            await self.db.command(
+                'collMod', self.confirmations.name, index={
+                    'keyPattern': {'created_at': 1},
+                    'expireAfterSeconds': expire_after,
+                })
+
+    async def on_cleanup(self, app):
+        if self.invalidation_bus:
+            await self.invalidation_bus.stop()
 
     async def create_confirmation(self, user, action, data=None):
-        while True:
-            code = get_random_string(30)
-            if not await self.confirmations.find_one(code):
-                break
-
+        '''Creates a confirmation in one request, replacing the previous one
+        of the same user and action. Code collisions are caught by the
+        unique index on `code`.
+        '''
         confirmation = {
-            'code': code,
             'user_id': user['_id'],
             'action': action,
             'data': data,
             'created_at': datetime.utcnow(),
         }
-        await self.confirmations.insert(confirmation)
-        return confirmation
+        while True:
+            confirmation['code'] = get_random_string(30)
+            try:
+                await self.confirmations.update(
+                    {'user_id': user['_id'], 'action': action},
+                    confirmation, upsert=True)
+            except DuplicateKeyError as e:
+                log.warning('Confirmation code collision', exc_info=e)
+                continue
+            return confirmation
 
     def get_confirmation(self, filter):
         if 'user' in filter:
@@ -55,7 +161,76 @@ class MotorStorage:
         return self.confirmations.find_one(filter)
 
     def delete_confirmation(self, confirmation):
-        return self.confirmations.remove(confirmation['_id'])
+        return self.confirmations.remove({'code': confirmation['code']})
+
+    async def consume_confirmation(self, code, min_created_at):
+        '''Deletes not expired confirmation and applies it to the user:
+        activates registration or changes email.
+
+        `min_created_at` is `{action: datetime}`, other actions are ignored.
+        Returns `(confirmation, user)` or `(None, None)`.
+        '''
+        confirmation = await self.confirmations.find_one_and_delete({
+            'code': code,
+            '$or': [{'action': action, 'created_at': {'$gt': created_at}}
+                    for action, created_at in min_created_at.items()],
+        })
+        if not confirmation:
+            return None, None
+        if confirmation['action'] == 'registration':
+            updates = {'status': 'active'}
+        else:
+            updates = {'email': confirmation['data']}
+        user = await self.users.find_one_and_update(
+            {'_id': confirmation['user_id']}, {'$set': updates},
+            return_document=ReturnDocument.AFTER)
+        if not user:
+            return None, None
+        await self.invalidate_user(user)
+        return confirmation, user
+
+    async def delete_expired_confirmations(self, min_created_at, limit):
+        '''Deletes up to `limit` confirmations created before
+        `min_created_at` (`{action: datetime}`) and users who didn't confirm
+        their registration. Returns the number of deleted confirmations and
+        ids of deleted users.
+        '''
+        expired = await self.confirmations.find({
+            '$or': [{'action': action, 'created_at': {'$lt': created_at}}
+                    for action, created_at in min_created_at.items()],
+        }, {'_id': 1, 'user_id': 1, 'action': 1}).to_list(limit)
+        deleted = 0
+        user_ids = [c['user_id'] for c in expired
+                    if c['action'] == 'registration']
+        if expired:
+            deleted = (await self.confirmations.delete_many(
+                {'_id': {'$in': [c['_id'] for c in expired]}})).deleted_count
+        if 'registration' in min_created_at:
+            user_ids += await self._unconfirmed_without_confirmation(
+                min_created_at['registration'], limit)
+        if user_ids:
+            filter = {'_id': {'$in': user_ids}, 'status': 'confirmation'}
+            users = await self.users.find(filter, {'_id': 1}).to_list(None)
+            user_ids = [user['_id'] for user in users]
+            await self.users.delete_many(filter)
+            for user in users:
+                await self.invalidate_user(user)
+        return deleted, user_ids
+
+    async def _unconfirmed_without_confirmation(self, created_before, limit):
+        # registration confirmations removed by the TTL index leave their
+        # users behind
+        users = await self.users.find({
+            'status': 'confirmation',
+            'created_at': {'$lt': created_before},
+        }, {'_id': 1}).to_list(limit)
+        user_ids = [user['_id'] for user in users]
+        if not user_ids:
+            return []
+        with_confirmation = set(await self.confirmations.distinct(
+            'user_id', {'user_id': {'$in': user_ids}}))
+        return [user_id for user_id in user_ids
+                if user_id not in with_confirmation]
 
     def user_id_from_string(self, id_str):
         try:
@@ -0,0 +1,240 @@
+import os
+import json
+import math
+import time
+import asyncio
+from logging import getLogger
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from aiohttp.web import HTTPServiceUnavailable
+from passlib.context import CryptContext
+
+from .cfg import cfg
+from . import metrics
+from .timing import phase
+
+
+log = getLogger(__name__)
+_executor = None
+_admission_configured = False
+HASHING = metrics.registry.histogram(
+    'aiohttp_login_password_hash_seconds',
+    'Password hashing time including the executor queue', ['operation'])
+
+
+def encrypt_password(password):
+    return _hash(_context_config(), password)
+
+
+def check_password(password, password_hash):
+    return _verify(_context_config(), password, password_hash)
+
+
+def verify_and_update_password(password, password_hash):
+    '''Returns `(is_valid, new_hash)`, where `new_hash` is not `None` if the
+    hash uses a deprecated scheme or costs lower than configured ones
+    '''
+    return _verify_and_update(_context_config(), password, password_hash)
+
+
+async def async_encrypt_password(password):
+    with HASHING.time(operation='hash'), phase('hash'):
+        return await run_hasher(_hash, _context_config(), password)
+
+
+async def async_check_password(password, password_hash):
+    with HASHING.time(operation='verify'), phase('hash'):
+        return await run_hasher(_verify, _context_config(), password,
+                                password_hash)
+
+
+async def async_verify_and_update_password(password, password_hash):
+    with HASHING.time(operation='verify'), phase('hash'):
+        return await run_hasher(_verify_and_update, _context_config(),
+                                password, password_hash)
+
+
+def password_context():
+    return _crypt_context(_context_config())
+
+
+def calibrate(target_time, samples=5):
+    '''Picks rounds of the default scheme to make a password check take
+    about `target_time` seconds on this machine
+
+    Updates `PASSWORD_CONTEXT` with the new `<scheme>__default_rounds`, so
+    new hashes get the calibrated cost. Existing hashes are rewritten only if
+    they go below `<scheme>__min_rounds`, which is left as is. The rounds
+    are kept within configured `<scheme>__min_rounds` / `__max_rounds`.
+    '''
+    context = CryptContext(**cfg.PASSWORD_CONTEXT)
+    scheme = context.default_scheme()
+    handler = context.handler(scheme)
+    if 'rounds' not in handler.setting_kwds:
+        log.warning('Can\'t calibrate %s: it has no rounds setting', scheme)
+        return None
+
+    min_rounds = max(handler.min_rounds,
+                     getattr(handler, 'min_desired_rounds', None) or 0)
+    max_rounds = min(handler.max_rounds,
+                     getattr(handler, 'max_desired_rounds', None) or
+                     handler.max_rounds)
+    rounds = handler.default_rounds
+    elapsed = _measure_check(handler, rounds, samples)
+    # the second pass corrects for the fixed per-check overhead, which
+    # dominates at low rounds
+    for _ in range(2):
+        if handler.rounds_cost == 'log2':
+            rounds += round(math.log2(target_time / elapsed))
+        else:
+            rounds = round(rounds * target_time / elapsed)
+        wanted, rounds = rounds, max(min_rounds, min(rounds, max_rounds))
+        elapsed = _measure_check(handler, rounds, samples)
+    if wanted != rounds:
+        log.warning('Can\'t calibrate %s to %.1f ms per check: %s rounds are '
+                    'out of the allowed %s-%s', scheme, target_time * 1000,
+                    wanted, min_rounds, max_rounds)
+
+    config = dict(cfg.PASSWORD_CONTEXT)
+    config['{}__default_rounds'.format(scheme)] = rounds
+    cfg['PASSWORD_CONTEXT'] = config
+
+    result = {
+        'scheme': scheme,
+        'rounds': rounds,
+        'check_time': elapsed,
+        'logins_per_second_per_core': 1 / elapsed,
+    }
+    log.info('Password hashing calibrated: %s rounds=%s, %.1f ms per check,'
+             ' ~%d logins/s per core', scheme, rounds, elapsed * 1000,
+             result['logins_per_second_per_core'])
+    return result
+
+
+def _measure_check(handler, rounds, samples):
+    handler = handler.using(rounds=rounds)
+    password_hash = handler.hash('calibration')
+    timings = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        handler.verify('calibration', password_hash)
+        timings.append(time.perf_counter() - started)
+    return sorted(timings)[len(timings) // 2]
+
+
+def _context_config():
+    # context settings are passed as a string to be hashable and picklable,
+    # so process pool workers could build the same context
+    return json.dumps(cfg.PASSWORD_CONTEXT, sort_keys=True)
+
+
+@lru_cache()
+def _crypt_context(config):
+    return CryptContext(**json.loads(config))
+
+
+def _hash(config, password):
+    return _crypt_context(config).hash(password)
+
+
+def _verify(config, password, password_hash):
+    return _crypt_context(config).verify(password, password_hash)
+
+
+def _verify_and_update(config, password, password_hash):
+    return _crypt_context(config).verify_and_update(password, password_hash)
+
+
+class Admission:
+    '''Limits hashing work: up to `max_in_flight` jobs run in the pool and
+    up to `max_queue` wait for a free slot. Others are rejected with
+    503 Service Unavailable right away, instead of waiting for ages.
+    '''
+    def __init__(self):
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.waiting = 0
+        self.in_flight = 0
+        self.configure(1, 0)
+
+    def configure(self, max_in_flight, max_queue):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.slots = asyncio.Semaphore(max_in_flight)
+
+    def stats(self):
+        return {
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'rejected': self.rejected,
+            'in_flight': self.in_flight,
+            'waiting': self.waiting,
+        }
+
+    async def __aenter__(self):
+        if self.slots.locked():
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise HTTPServiceUnavailable(headers={
+                    'Retry-After': str(cfg.PASSWORD_HASH_RETRY_AFTER)})
+            self.queued += 1
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.admitted += 1
+        self.in_flight += 1
+
+    async def __aexit__(self, *args):
+        self.in_flight -= 1
+        self.slots.release()
+
+
+admission = Admission()
+
+
+async def run_hasher(func, *args):
+    '''Runs CPU-bound hashing function in the configured pool through
+    the admission control
+    '''
+    executor = _get_executor()
+    async with admission:
+        if executor is None:
+            return func(*args)
+        return await cfg.APP.loop.run_in_executor(executor, func, *args)
+
+
+def _get_executor():
+    '''Returns the configured pool, or None if hashing runs right in the
+    event loop
+    '''
+    global _executor, _admission_configured
+    kind = cfg.PASSWORD_HASH_EXECUTOR
+    workers = cfg.PASSWORD_HASH_WORKERS
+    if _executor is None and kind:
+        if kind == 'thread':
+            _executor = ThreadPoolExecutor(workers)
+        elif kind == 'process':
+            _executor = ProcessPoolExecutor(workers)
+        else:
+            raise RuntimeError(
+                'Unknown PASSWORD_HASH_EXECUTOR: {!r}'.format(kind))
+    if not _admission_configured:
+        # hashing in the event loop runs one job at a time anyway
+        admission.configure(
+            (cfg.PASSWORD_HASH_MAX_IN_FLIGHT or workers or os.cpu_count()
+             if kind else 1),
+            cfg.PASSWORD_HASH_MAX_QUEUE)
+        _admission_configured = True
+    return _executor
+
+
+async def shutdown(app=None):
+    global _executor, _admission_configured
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+    _executor = None
+    _admission_configured = False
@@ -35,3 +35,5 @@ CREATE TABLE confirmations (
     created_at      timestamp NOT NULL
 );
 CREATE UNIQUE INDEX ON confirmations (user_id, action);
+-- cleanup of expired confirmations
+CREATE INDEX ON confirmations (created_at);
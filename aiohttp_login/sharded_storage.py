@@ -0,0 +1,347 @@
+'''
+Storage which splits users across a few postgres databases.
+
+Every shard is an `AsyncpgStorage` with the usual tables. A user lives in
+the shard picked by a hash of their email at registration. The global
+email index table tells which shard to go for a user by email:
+
+    CREATE TABLE user_shards (
+        email       citext PRIMARY KEY,
+        shard       int NOT NULL,
+        user_id     int,
+        UNIQUE (shard, user_id)
+    );
+
+User ids are `ShardId(shard, id)` tuples and confirmation codes are
+prefixed with the shard number, so lookups by them (including session
+lookups) go straight to the right shard. Lookups by social ids go to all
+the shards at once.
+
+    shards = [AsyncpgStorage(pool) for pool in pools]
+    storage = ShardedStorage(shards)
+
+With `MemoryShardIndex` shards can be any storages, e.g. in-memory ones for
+tests.
+'''
+import asyncio
+import zlib
+from collections import namedtuple
+from logging import getLogger
+
+from .memory_storage import DuplicateKeyError
+from . import instrumentation
+
+
+log = getLogger(__name__)
+ShardId = namedtuple('ShardId', 'shard id')
+
+
+class ShardedStorage:
+    def __init__(self, shards, *,
+                 index=None,
+                 index_pool=None,
+                 index_table_name='user_shards',
+                 user_cache=None):
+        self.shards = shards
+        self.index = index or PgShardIndex(
+            index_pool or shards[0].pool, index_table_name)
+        self.user_cache = user_cache
+
+    def shard_for_email(self, email):
+        '''Picks a shard of a new user
+
+        >>> ShardedStorage([None] * 4, index_pool=1).shard_for_email('Foo@x')
+        3
+        '''
+        return zlib.crc32(email.lower().encode('utf-8')) % len(self.shards)
+
+    async def get_user(self, filter, fields=None):
+        filter = dict(filter)
+        if fields and 'id' not in fields:
+            fields = ('id',) + tuple(fields)
+        if 'id' in filter:
+            shard, filter['id'] = filter['id']
+            return self._user(
+                shard, await self.shards[shard].get_user(filter, fields))
+
+        if 'email' in filter:
+            shard = await self.index.find_shard(filter['email'])
+            if shard is None:
+                return None
+            return self._user(
+                shard, await self.shards[shard].get_user(filter, fields))
+
+        users = await asyncio.gather(*[
+            shard.get_user(dict(filter), fields) for shard in self.shards])
+        for shard, user in enumerate(users):
+            if user:
+                return self._user(shard, user)
+
+    async def create_user(self, data):
+        shard = self.shard_for_email(data['email'])
+        # the index reserves the email, as a unique index would do
+        await self.index.reserve(data['email'], shard)
+        created = False
+        try:
+            await self.shards[shard].create_user(data)
+            created = True
+            await self.index.set_user_id(data['email'], data['id'])
+        except BaseException:
+            # cancellation included, the email would stay reserved
+            if created:
+                await self.shards[shard].delete_user({'id': data['id']})
+            await self.index.release(data['email'])
+            raise
+        data['id'] = ShardId(shard, data['id'])
+        return data
+
+    async def bulk_create_users(self, users):
+        '''Users are created one by one, as every one of them needs its id
+        in the email index
+        '''
+        errors = []
+        for index, user in enumerate(users):
+            try:
+                await self.create_user(user)
+            except Exception as e:
+                errors.append((index, str(e)))
+        return errors
+
+    async def update_user(self, user, updates):
+        shard, user_id = user['id']
+        if 'email' in updates:
+            await self.index.update_email(shard, user_id, updates['email'])
+        await self.shards[shard].update_user({'id': user_id}, updates)
+        self._invalidate(user)
+
+    async def delete_user(self, user):
+        shard, user_id = user['id']
+        await self.shards[shard].delete_user({'id': user_id})
+        await self.index.delete_users(shard, [user_id])
+        self._invalidate(user)
+
+    async def create_confirmation(self, user, action, data=None):
+        shard, user_id = user['id']
+        confirmation = await self.shards[shard].create_confirmation(
+            {'id': user_id}, action, data)
+        return self._confirmation(shard, confirmation)
+
+    async def get_confirmation(self, filter):
+        filter = dict(filter)
+        if 'code' in filter:
+            shard, filter['code'] = _split_code(filter['code'])
+            if shard is None or shard >= len(self.shards):
+                return None
+        else:
+            shard, user_id = filter.pop('user')['id']
+            filter['user'] = {'id': user_id}
+        return self._confirmation(
+            shard, await self.shards[shard].get_confirmation(filter))
+
+    async def delete_confirmation(self, confirmation):
+        shard, code = _split_code(confirmation['code'])
+        await self.shards[shard].delete_confirmation({
+            'code': code, 'user_id': confirmation['user_id'].id})
+
+    async def consume_confirmation(self, code, min_created_at):
+        '''A new email is moved in the index before the shard takes it, so
+        a taken email fails the consuming, as a unique index would do
+        '''
+        shard, code = _split_code(code)
+        if shard is None or shard >= len(self.shards):
+            return None, None
+        storage = self.shards[shard]
+        moved = await self._move_email(storage, shard, code)
+        try:
+            confirmation, user = await storage.consume_confirmation(
+                code, min_created_at)
+        except BaseException:
+            if moved:
+                await self.index.update_email(shard, *moved)
+            raise
+        if not confirmation:
+            if moved:
+                await self.index.update_email(shard, *moved)
+            return None, None
+        user = self._user(shard, user)
+        self._invalidate(user)
+        return self._confirmation(shard, confirmation), user
+
+    async def delete_expired_confirmations(self, min_created_at, limit):
+        '''Deletes up to `limit` expired confirmations in every shard'''
+        results = await asyncio.gather(*[
+            shard.delete_expired_confirmations(min_created_at, limit)
+            for shard in self.shards])
+        confirmations, user_ids = 0, []
+        for shard, (shard_confirmations, shard_user_ids) in enumerate(
+                results):
+            confirmations += shard_confirmations
+            user_ids += [ShardId(shard, user_id)
+                         for user_id in shard_user_ids]
+            if shard_user_ids:
+                # frees emails of the removed users
+                await self.index.delete_users(shard, shard_user_ids)
+        for user_id in user_ids:
+            self._invalidate({'id': user_id})
+        return confirmations, user_ids
+
+    async def _move_email(self, storage, shard, code):
+        '''Moves the user of a change_email confirmation to the new email
+        in the index, returns `(user_id, old_email)` to move it back
+        '''
+        confirmation = await storage.get_confirmation({'code': code})
+        if not confirmation or confirmation['action'] != 'change_email':
+            return None
+        user = await storage.get_user(
+            {'id': confirmation['user_id']}, ('id', 'email'))
+        if not user:
+            return None
+        await self.index.update_email(shard, user['id'], confirmation['data'])
+        return user['id'], user['email']
+
+    def pin_to_primary(self, user):
+        shard, user_id = user['id']
+        pin_to_primary = getattr(self.shards[shard], 'pin_to_primary', None)
+        if pin_to_primary:
+            pin_to_primary({'id': user_id, 'email': user.get('email')})
+
+    def user_id_from_string(self, id_str):
+        '''
+        >>> ShardedStorage([None] * 2, index_pool=1).user_id_from_string('1:5')
+        ShardId(shard=1, id=5)
+        '''
+        try:
+            shard, user_id = id_str.split(':')
+            shard_id = ShardId(int(shard), int(user_id))
+        except ValueError as ex:
+            log.error('Can\'t convert string into id', exc_info=ex)
+            return None
+        if shard_id.shard >= len(self.shards):
+            log.error('Unknown shard in user id: %s', id_str)
+            return None
+        return shard_id
+
+    def user_session_id(self, user):
+        return '{}:{}'.format(*user['id'])
+
+    async def on_startup(self, app):
+        for shard in self.shards:
+            if hasattr(shard, 'on_startup'):
+                await shard.on_startup(app)
+
+    async def on_cleanup(self, app):
+        for shard in self.shards:
+            if hasattr(shard, 'on_cleanup'):
+                await shard.on_cleanup(app)
+
+    def _invalidate(self, user):
+        if self.user_cache:
+            self.user_cache.invalidate(user['id'])
+
+    def _user(self, shard, user):
+        if not user:
+            return user
+        user = dict(user)
+        user['id'] = ShardId(shard, user['id'])
+        return user
+
+    def _confirmation(self, shard, confirmation):
+        if not confirmation:
+            return confirmation
+        confirmation = dict(confirmation)
+        confirmation['code'] = '{}.{}'.format(shard, confirmation['code'])
+        confirmation['user_id'] = ShardId(shard, confirmation['user_id'])
+        return confirmation
+
+
+class PgShardIndex:
+    '''Email index in a postgres table, see the module docstring'''
+    def __init__(self, pool, table_name='user_shards'):
+        self.pool = pool
+        self.tbl = table_name
+
+    async def reserve(self, email, shard):
+        await self._execute(
+            'INSERT INTO {} (email, shard) VALUES ($1, $2)', email, shard)
+
+    async def set_user_id(self, email, user_id):
+        await self._execute(
+            'UPDATE {} SET user_id=$1 WHERE email=$2', user_id, email)
+
+    async def release(self, email):
+        await self._execute('DELETE FROM {} WHERE email=$1', email)
+
+    async def find_shard(self, email):
+        async with instrumentation.acquire(self.pool, 'index') as conn:
+            return await conn.fetchval(
+                'SELECT shard FROM {} WHERE email=$1'.format(self.tbl), email)
+
+    async def update_email(self, shard, user_id, email):
+        await self._execute(
+            'UPDATE {} SET email=$1 WHERE shard=$2 AND user_id=$3',
+            email, shard, user_id)
+
+    async def delete_users(self, shard, user_ids):
+        await self._execute(
+            'DELETE FROM {} WHERE shard=$1 AND user_id=any($2)',
+            shard, user_ids)
+
+    async def _execute(self, statement, *args):
+        async with instrumentation.acquire(self.pool, 'index') as conn:
+            await conn.execute(statement.format(self.tbl), *args)
+
+
+class MemoryShardIndex:
+    '''Email index in process memory, for tests and single node setups
+
+    >>> index = MemoryShardIndex()
+    >>> asyncio.run(index.reserve('Foo@x', 1))
+    >>> asyncio.run(index.find_shard('foo@X'))
+    1
+    '''
+    def __init__(self):
+        # lowercased email -> [shard, user_id]
+        self.entries = {}
+
+    async def reserve(self, email, shard):
+        if email.lower() in self.entries:
+            raise DuplicateKeyError('email')
+        self.entries[email.lower()] = [shard, None]
+
+    async def set_user_id(self, email, user_id):
+        self.entries[email.lower()][1] = user_id
+
+    async def release(self, email):
+        self.entries.pop(email.lower(), None)
+
+    async def find_shard(self, email):
+        entry = self.entries.get(email.lower())
+        return entry and entry[0]
+
+    async def update_email(self, shard, user_id, email):
+        if email.lower() in self.entries:
+            if self.entries[email.lower()] == [shard, user_id]:
+                return
+            raise DuplicateKeyError('email')
+        for key, entry in list(self.entries.items()):
+            if entry == [shard, user_id]:
+                del self.entries[key]
+        self.entries[email.lower()] = [shard, user_id]
+
+    async def delete_users(self, shard, user_ids):
+        for key, entry in list(self.entries.items()):
+            if entry[0] == shard and entry[1] in user_ids:
+                del self.entries[key]
+
+
+def _split_code(code):
+    '''
+    >>> _split_code('2.abc')
+    (2, 'abc')
+    >>> _split_code('abc')
+    (None, 'abc')
+    '''
+    shard, _, local_code = code.partition('.')
+    if not local_code or not shard.isdigit():
+        return None, code
+    return int(shard), local_code
@@ -1,8 +1,11 @@
 from logging import getLogger
+from functools import lru_cache
 
 
 log = getLogger(__name__)
 LOG_TPL = '%s <--%s'
+# number of prebuilt statements kept per operation
+STATEMENT_CACHE_SIZE = 256
 
 
 def find_one(conn, table, filter, fields=None):
@@ -17,12 +20,20 @@ def find_one_sql(table, filter, fields=None):
     ('SELECT * FROM tbl WHERE bar=$1 AND foo=$2', ['baz', 10])
     >>> find_one_sql('tbl', {'id': 10}, fields=['foo', 'bar'])
     ('SELECT foo, bar FROM tbl WHERE id=$1', [10])
+
+    Statements are built once per table and set of keys
+    >>> find_one_sql('tbl', {'id': 1})[0] is find_one_sql('tbl', {'id': 2})[0]
+    True
     '''
     keys, values = _split_dict(filter)
+    return _find_one_stmt(table, keys, tuple(fields or ())), values
+
+
+@lru_cache(STATEMENT_CACHE_SIZE)
+def _find_one_stmt(table, keys, fields):
     fields = ', '.join(fields) if fields else '*'
     where = _pairs(keys)
-    sql = 'SELECT {} FROM {} WHERE {}'.format(fields, table, where)
-    return sql, values
+    return 'SELECT {} FROM {} WHERE {}'.format(fields, table, where)
 
 
 def insert(conn, table, data, returning='id'):
@@ -43,12 +54,42 @@ def insert_sql(table, data, returning='id'):
     ('INSERT INTO tbl (foo, id) VALUES ($1, $2) RETURNING pk', ['bar', 1])
     '''
     keys, values = _split_dict(data)
-    sql = 'INSERT INTO {} ({}) VALUES ({}){}'.format(
+    return _insert_stmt(table, keys, returning), values
+
+
+@lru_cache(STATEMENT_CACHE_SIZE)
+def _insert_stmt(table, keys, returning):
+    return 'INSERT INTO {} ({}) VALUES ({}){}'.format(
         table,
         ', '.join(keys),
-        ', '.join(_placeholders(data)),
+        ', '.join(_placeholders(keys)),
         ' RETURNING {}'.format(returning) if returning else '')
-    return sql, values
+
+
+def upsert(conn, table, data, conflict):
+    sql, values = upsert_sql(table, data, conflict)
+    log.debug(LOG_TPL, sql, values)
+    return conn.execute(sql, *values)
+
+
+def upsert_sql(table, data, conflict):
+    '''Inserts a row or updates the one conflicting by `conflict` columns
+
+    >>> upsert_sql('tbl', {'a': 1, 'b': 2, 'c': 3}, ['b', 'a'])
+    ... # doctest: +NORMALIZE_WHITESPACE
+    ('INSERT INTO tbl (a, b, c) VALUES ($1, $2, $3)
+      ON CONFLICT (a, b) DO UPDATE SET c=EXCLUDED.c', [1, 2, 3])
+    '''
+    keys, values = _split_dict(data)
+    return _upsert_stmt(table, keys, tuple(sorted(conflict))), values
+
+
+@lru_cache(STATEMENT_CACHE_SIZE)
+def _upsert_stmt(table, keys, conflict):
+    changes = ', '.join('{0}=EXCLUDED.{0}'.format(k)
+                        for k in keys if k not in conflict)
+    return '{} ON CONFLICT ({}) DO UPDATE SET {}'.format(
+        _insert_stmt(table, keys, None), ', '.join(conflict), changes)
 
 
 def update(conn, table, filter, updates):
@@ -64,11 +105,14 @@ def update_sql(table, filter, updates):
     '''
     where_keys, where_vals = _split_dict(filter)
     up_keys, up_vals = _split_dict(updates)
+    return _update_stmt(table, where_keys, up_keys), up_vals + where_vals
+
+
+@lru_cache(STATEMENT_CACHE_SIZE)
+def _update_stmt(table, where_keys, up_keys):
     changes = _pairs(up_keys, sep=', ')
     where = _pairs(where_keys, start=len(up_keys) + 1)
-    sql = 'UPDATE {} SET {} WHERE {}'.format(
-        table, changes, where)
-    return sql, up_vals + where_vals
+    return 'UPDATE {} SET {} WHERE {}'.format(table, changes, where)
 
 
 def delete(conn, table, filter):
@@ -83,9 +127,12 @@ def delete_sql(table, filter):
     ('DELETE FROM tbl WHERE bar=$1 AND foo=$2', ['baz', 10])
     '''
     keys, values = _split_dict(filter)
-    where = _pairs(keys)
-    sql = 'DELETE FROM {} WHERE {}'.format(table, where)
-    return sql, values
+    return _delete_stmt(table, keys), values
+
+
+@lru_cache(STATEMENT_CACHE_SIZE)
+def _delete_stmt(table, keys):
+    return 'DELETE FROM {} WHERE {}'.format(table, _pairs(keys))
 
 
 def _pairs(keys, *, start=1, sep=' AND '):
@@ -108,12 +155,13 @@ def _placeholders(variables):
 
 
 def _split_dict(dic):
-    '''Split dict into sorted keys and values
+    '''Split dict into sorted keys and values, keys are returned as a tuple
+    to be used as a part of statement cache key
 
     >>> _split_dict({'b': 2, 'a': 1})
-    (['a', 'b'], [1, 2])
+    (('a', 'b'), [1, 2])
     '''
-    keys = sorted(dic.keys())
+    keys = tuple(sorted(dic))
     return keys, [dic[k] for k in keys]
 
 
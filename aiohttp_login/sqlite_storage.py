@@ -0,0 +1,383 @@
+'''
+Storage on top of SQLite for single node deployments.
+
+    storage = SqliteStorage('/var/lib/app/auth.sqlite')
+    aiohttp_login.setup(app, storage, {...})
+
+Tables are created by `aiohttp_login/sqlite_tables.sql`. The database
+works in WAL mode, so reads from a few connections don't wait for writes.
+All the writes go through one connection: they are queued and the queue
+is committed in batches (a transaction per batch, a savepoint per write),
+which saves a disk sync per write under load.
+'''
+import asyncio
+import sqlite3
+from datetime import datetime
+from functools import lru_cache
+from logging import getLogger
+
+import aiosqlite
+
+from .utils import get_random_string
+from . import sql
+
+
+log = getLogger(__name__)
+DATETIME_FIELDS = ['created_at']
+
+
+class SqliteStorage:
+    def __init__(self, path, *,
+                 user_table_name='users',
+                 confirmation_table_name='confirmations',
+                 read_connections=4,
+                 write_batch_size=100,
+                 user_cache=None):
+        self.path = path
+        self.user_tbl = user_table_name
+        self.confirm_tbl = confirmation_table_name
+        self.read_connections = read_connections
+        self.write_batch_size = write_batch_size
+        self.user_cache = user_cache
+        self.readers = None
+        self.writer = None
+        self.write_queue = None
+        self.write_task = None
+
+    async def connect(self):
+        if self.writer is not None:
+            return
+        self.writer = await self._connect()
+        await self.writer.execute('PRAGMA journal_mode=WAL')
+        # with WAL it's still durable against app crashes, only a power
+        # loss can roll back the last commits
+        await self.writer.execute('PRAGMA synchronous=NORMAL')
+        self.readers = asyncio.Queue()
+        for _ in range(self.read_connections):
+            self.readers.put_nowait(await self._connect())
+        self.write_queue = asyncio.Queue()
+        self.write_task = asyncio.ensure_future(self._process_writes())
+
+    async def close(self):
+        if self.writer is None:
+            return
+        self.write_task.cancel()
+        try:
+            await self.write_task
+        except asyncio.CancelledError:
+            pass
+        while not self.readers.empty():
+            await self.readers.get_nowait().close()
+        await self.writer.close()
+        self.writer = None
+
+    async def on_startup(self, app):
+        await self.connect()
+
+    async def on_cleanup(self, app):
+        await self.close()
+
+    async def _connect(self):
+        conn = await aiosqlite.connect(self.path, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        await conn.execute('PRAGMA foreign_keys=ON')
+        await conn.execute('PRAGMA busy_timeout=5000')
+        return conn
+
+    async def read(self, statement, values):
+        conn = await self.readers.get()
+        try:
+            log.debug(sql.LOG_TPL, statement, values)
+            async with conn.execute(statement, _to_db(values)) as cursor:
+                return _from_db(await cursor.fetchone())
+        finally:
+            self.readers.put_nowait(conn)
+
+    def write(self, func):
+        '''Runs `await func(conn)` on the writer connection as a part of the
+        next batch, returns its result after the batch is committed
+        '''
+        future = asyncio.get_event_loop().create_future()
+        self.write_queue.put_nowait((func, future))
+        return future
+
+    async def _process_writes(self):
+        while True:
+            batch = [await self.write_queue.get()]
+            while (len(batch) < self.write_batch_size and
+                   not self.write_queue.empty()):
+                batch.append(self.write_queue.get_nowait())
+            try:
+                await self._write_batch(batch)
+            except Exception as e:
+                log.error('Write batch failed', exc_info=e)
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    async def _write_batch(self, batch):
+        conn = self.writer
+        results = []
+        await conn.execute('BEGIN IMMEDIATE')
+        try:
+            for func, _ in batch:
+                # a failed write is rolled back alone
+                await conn.execute('SAVEPOINT write')
+                try:
+                    results.append((True, await func(conn)))
+                except Exception as e:
+                    await conn.execute('ROLLBACK TO write')
+                    results.append((False, e))
+                await conn.execute('RELEASE write')
+            await conn.execute('COMMIT')
+        except BaseException:
+            await conn.execute('ROLLBACK')
+            raise
+        for (_, future), (ok, result) in zip(batch, results):
+            if future.done():
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+    async def get_user(self, filter, fields=None):
+        return await self.read(
+            *_sqlite(sql.find_one_sql(self.user_tbl, filter, fields)))
+
+    async def create_user(self, data):
+        data.setdefault('created_at', datetime.utcnow())
+        data['id'] = await self.write(
+            lambda conn: _insert(conn, self.user_tbl, data))
+        return data
+
+    async def bulk_create_users(self, users):
+        '''Inserts users in one statement. If the batch fails (e.g. an email
+        is taken), inserts them one by one to find the bad rows.
+        Returns `[(index, error), ...]` of not inserted users.
+        '''
+        now = datetime.utcnow()
+        columns = sorted(set().union(*users) | {'created_at'})
+        statement = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            self.user_tbl, ', '.join(columns), ', '.join('?' * len(columns)))
+        records = [_to_db([user.get(c, now if c == 'created_at' else None)
+                           for c in columns]) for user in users]
+        try:
+            await self.write(lambda conn: conn.executemany(statement, records))
+            return []
+        except sqlite3.IntegrityError as e:
+            log.warning('Bulk insert failed, retrying one by one: %s', e)
+
+        results = await asyncio.gather(*[
+            self.write(lambda conn, record=record: conn.execute(
+                statement, record))
+            for record in records], return_exceptions=True)
+        return [(index, str(result)) for index, result in enumerate(results)
+                if isinstance(result, Exception)]
+
+    async def update_user(self, user, updates):
+        statement, values = _sqlite(
+            sql.update_sql(self.user_tbl, {'id': user['id']}, updates))
+        await self.write(lambda conn: _execute(conn, statement, values))
+        await self.invalidate_user(user)
+
+    async def delete_user(self, user):
+        statement, values = _sqlite(
+            sql.delete_sql(self.user_tbl, {'id': user['id']}))
+        await self.write(lambda conn: _execute(conn, statement, values))
+        await self.invalidate_user(user)
+
+    async def invalidate_user(self, user):
+        if self.user_cache:
+            self.user_cache.invalidate(user['id'])
+
+    async def create_confirmation(self, user, action, data=None):
+        '''Creates a confirmation, replacing the previous one of the same
+        user and action
+        '''
+        confirmation = {
+            'user_id': user['id'],
+            'action': action,
+            'data': data,
+            'created_at': datetime.utcnow(),
+        }
+        while True:
+            confirmation['code'] = get_random_string(30)
+            statement, values = _sqlite(sql.upsert_sql(
+                self.confirm_tbl, confirmation, ['user_id', 'action']))
+            try:
+                await self.write(
+                    lambda conn: _execute(conn, statement, values))
+            except sqlite3.IntegrityError as e:
+                # the code is taken, other errors (e.g. an unknown user)
+                # wouldn't go away with another code
+                if str(e) != 'UNIQUE constraint failed: {}.code'.format(
+                        self.confirm_tbl):
+                    raise
+                log.warning('Confirmation code collision', exc_info=e)
+                continue
+            return confirmation
+
+    async def get_confirmation(self, filter):
+        if 'user' in filter:
+            filter['user_id'] = filter.pop('user')['id']
+        return await self.read(
+            *_sqlite(sql.find_one_sql(self.confirm_tbl, filter)))
+
+    async def delete_confirmation(self, confirmation):
+        statement, values = _sqlite(
+            sql.delete_sql(self.confirm_tbl, {'code': confirmation['code']}))
+        await self.write(lambda conn: _execute(conn, statement, values))
+
+    async def consume_confirmation(self, code, min_created_at):
+        '''Deletes not expired confirmation and applies it to the user:
+        activates registration or changes email. The writer runs it alone,
+        so it's atomic.
+
+        `min_created_at` is `{action: datetime}`, other actions are ignored.
+        Returns `(confirmation, user)` or `(None, None)`.
+        '''
+        confirmation, user = await self.write(
+            lambda conn: self._consume(conn, code, min_created_at))
+        if user:
+            await self.invalidate_user(user)
+        return confirmation, user
+
+    async def _consume(self, conn, code, min_created_at):
+        confirmation = await _fetchone(
+            conn, 'SELECT * FROM {} WHERE code=?'.format(self.confirm_tbl),
+            [code])
+        if (not confirmation or
+                confirmation['action'] not in min_created_at or
+                confirmation['created_at'] <=
+                min_created_at[confirmation['action']]):
+            return None, None
+        await _execute(conn, 'DELETE FROM {} WHERE code=?'.format(
+            self.confirm_tbl), [code])
+        if confirmation['action'] == 'registration':
+            updates = {'status': 'active'}
+        elif confirmation['action'] == 'change_email':
+            updates = {'email': confirmation['data']}
+        else:
+            updates = {}
+        if updates:
+            await _execute(conn, *_sqlite(sql.update_sql(
+                self.user_tbl, {'id': confirmation['user_id']}, updates)))
+        user = await _fetchone(
+            conn, 'SELECT * FROM {} WHERE id=?'.format(self.user_tbl),
+            [confirmation['user_id']])
+        if not user:
+            return None, None
+        return confirmation, user
+
+    async def delete_expired_confirmations(self, min_created_at, limit):
+        '''Deletes up to `limit` confirmations created before
+        `min_created_at` (`{action: datetime}`) and users who didn't confirm
+        their registration. Returns the number of deleted confirmations and
+        ids of deleted users.
+        '''
+        actions = tuple(sorted(min_created_at))
+        values = []
+        for action in actions:
+            values += [action, min_created_at[action]]
+        confirmations, user_ids = await self.write(
+            lambda conn: self._delete_expired(
+                conn, actions, _to_db(values + [limit])))
+        for user_id in user_ids:
+            await self.invalidate_user({'id': user_id})
+        return confirmations, user_ids
+
+    async def _delete_expired(self, conn, actions, values):
+        select, delete_users = _delete_expired_stmts(
+            self.user_tbl, self.confirm_tbl, actions)
+        log.debug(sql.LOG_TPL, select, values)
+        async with conn.execute(select, values) as cursor:
+            expired = await cursor.fetchall()
+        codes = [row['code'] for row in expired]
+        if not codes:
+            return 0, []
+        await conn.executemany('DELETE FROM {} WHERE code=?'.format(
+            self.confirm_tbl), [[code] for code in codes])
+        user_ids = []
+        for row in expired:
+            if row['action'] != 'registration':
+                continue
+            cursor = await conn.execute(delete_users, [row['user_id']])
+            if cursor.rowcount:
+                user_ids.append(row['user_id'])
+        return len(codes), user_ids
+
+    def user_id_from_string(self, id_str):
+        try:
+            return int(id_str)
+        except ValueError as ex:
+            log.error('Can\'t convert string into id', exc_info=ex)
+
+    def user_session_id(self, user):
+        return str(user['id'])
+
+
+@lru_cache(sql.STATEMENT_CACHE_SIZE)
+def _delete_expired_stmts(users, confirm, actions):
+    expiration = ' OR '.join(
+        '(action=? AND created_at<?)' for _ in actions)
+    select = '''
+        SELECT code, user_id, action FROM {} WHERE {} LIMIT ?
+    '''.format(confirm, expiration)
+    delete_users = '''
+        DELETE FROM {users} WHERE id=? AND status='confirmation'
+            AND NOT EXISTS (
+                SELECT 1 FROM {confirm} WHERE user_id={users}.id)
+    '''.format(users=users, confirm=confirm)
+    return select, delete_users
+
+
+async def _insert(conn, table, data):
+    statement, values = _sqlite(sql.insert_sql(table, data, None))
+    cursor = await _execute(conn, statement, values)
+    return cursor.lastrowid
+
+
+async def _execute(conn, statement, values):
+    log.debug(sql.LOG_TPL, statement, values)
+    return await conn.execute(statement, _to_db(values))
+
+
+async def _fetchone(conn, statement, values):
+    log.debug(sql.LOG_TPL, statement, values)
+    async with conn.execute(statement, _to_db(values)) as cursor:
+        return _from_db(await cursor.fetchone())
+
+
+def _sqlite(statement_and_values):
+    statement, values = statement_and_values
+    return _placeholders(statement), values
+
+
+@lru_cache(sql.STATEMENT_CACHE_SIZE)
+def _placeholders(statement):
+    '''Turns postgres placeholders into sqlite ones
+
+    >>> _placeholders('SELECT * FROM tbl WHERE a=$1 AND b=$2')
+    'SELECT * FROM tbl WHERE a=?1 AND b=?2'
+    '''
+    return statement.replace('$', '?')
+
+
+def _to_db(values):
+    '''
+    >>> _to_db([1, datetime(2020, 1, 2, 3, 4, 5)])
+    [1, '2020-01-02 03:04:05.000000']
+    '''
+    return [v.isoformat(' ', 'microseconds') if isinstance(v, datetime)
+            else v for v in values]
+
+
+def _from_db(row):
+    if row is None:
+        return None
+    row = dict(row)
+    for field in DATETIME_FIELDS:
+        if isinstance(row.get(field), str):
+            row[field] = datetime.fromisoformat(row[field])
+    return row
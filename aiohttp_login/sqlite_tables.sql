@@ -0,0 +1,34 @@
+PRAGMA journal_mode = WAL;
+
+-- users
+DROP TABLE IF EXISTS confirmations;
+DROP TABLE IF EXISTS users;
+CREATE TABLE users (
+    id              integer PRIMARY KEY AUTOINCREMENT,
+    name            text NOT NULL,
+    -- case independent, as citext in postgres
+    email           text NOT NULL UNIQUE COLLATE NOCASE,
+    password        text NOT NULL,
+    status          text NOT NULL CHECK (status IN (
+                        'confirmation', 'active', 'banned')),
+    created_at      timestamp NOT NULL,
+    created_ip      text NOT NULL,
+    vkontakte       text UNIQUE,
+    google          text UNIQUE,
+    facebook        text UNIQUE
+);
+
+
+-- confirmations
+CREATE TABLE confirmations (
+    code            text PRIMARY KEY,
+    user_id         integer REFERENCES users(id),
+    action          text NOT NULL CHECK (action IN (
+                        'registration', 'reset_password', 'change_email')),
+    data            text,
+    created_at      timestamp NOT NULL
+);
+CREATE UNIQUE INDEX confirmations_user_id_action
+    ON confirmations (user_id, action);
+-- cleanup of expired confirmations
+CREATE INDEX confirmations_created_at ON confirmations (created_at);
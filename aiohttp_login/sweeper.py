@@ -0,0 +1,80 @@
+'''
+Background removal of expired confirmations.
+
+Expired confirmations are deleted in batches, together with users who
+never confirmed their registration, so abandoned registrations don't keep
+their emails taken forever. Storages evict removed users from their user
+caches. The task is started by `setup()` if `CLEANUP_INTERVAL` is set and
+the storage supports it, see also `CLEANUP_BATCH_SIZE` setting. Removed
+rows are counted in `sweeper.stats`.
+'''
+import asyncio
+from time import time
+from logging import getLogger
+
+from .cfg import cfg
+from .utils import confirmation_cutoffs
+
+
+log = getLogger(__name__)
+ACTIONS = ['registration', 'reset_password', 'change_email']
+APP_KEY = 'aiohttp_login_sweeper'
+
+stats = {
+    'runs': 0,
+    'errors': 0,
+    'confirmations': 0,
+    'users': 0,
+    'last_run_at': None,
+}
+
+
+async def sweep(storage=None, batch_size=None):
+    '''Removes all the expired confirmations batch by batch, returns
+    `(confirmations, users)` numbers of removed rows
+    '''
+    storage = storage or cfg.STORAGE
+    batch_size = batch_size or cfg.CLEANUP_BATCH_SIZE
+    removed_confirmations = removed_users = 0
+    while True:
+        confirmations, user_ids = await storage.delete_expired_confirmations(
+            confirmation_cutoffs(ACTIONS), batch_size)
+        removed_confirmations += confirmations
+        removed_users += len(user_ids)
+        stats['confirmations'] += confirmations
+        stats['users'] += len(user_ids)
+        if confirmations < batch_size:
+            break
+    stats['runs'] += 1
+    stats['last_run_at'] = time()
+    if removed_confirmations:
+        log.info('Removed %s expired confirmations and %s unconfirmed users',
+                 removed_confirmations, removed_users)
+    return removed_confirmations, removed_users
+
+
+async def start(app):
+    app[APP_KEY] = asyncio.ensure_future(_run())
+
+
+async def stop(app):
+    task = app.get(APP_KEY)
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+async def _run():
+    while True:
+        try:
+            await sweep()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            stats['errors'] += 1
+            log.error('Expired confirmations cleanup failed', exc_info=e)
+        await asyncio.sleep(cfg.CLEANUP_INTERVAL)
@@ -0,0 +1,181 @@
+'''
+Breaks sampled requests into phases: session load, form parsing and CSRF,
+storage calls, password hashing, template rendering and SMTP.
+
+It's enabled by `SERVER_TIMING_SAMPLE_RATE`, then a sampled request gets
+the `Server-Timing` header and a log line:
+
+    Server-Timing: session;dur=0.41, form;dur=0.22, storage;dur=1.53,
+                   hash;dur=251.2, total;dur=254.01
+
+    {"method": "POST", "path": "/auth/login/", "status": 302,
+     "total": 254.01, "phases": {"session": {"dur": 0.41, "calls": 2}, ...}}
+
+Durations are in milliseconds. A phase doesn't include the nested ones,
+e.g. loading of the session while parsing a form counts as `session`.
+Phases of concurrent tasks (e.g. a lazy user load) are tracked separately,
+so they can overlap. Time which isn't covered by any phase is only
+included in `total`.
+'''
+import json
+from asyncio import current_task
+from contextlib import nullcontext
+from contextvars import ContextVar
+from functools import wraps
+from logging import getLogger
+from random import random
+from time import perf_counter
+
+from aiohttp.web import HTTPException
+import aiohttp_session
+
+from .cfg import cfg
+
+
+log = getLogger(__name__)
+_timer = ContextVar('aiohttp_login_timer', default=None)
+_untimed = nullcontext()
+
+
+def phase(name):
+    '''Records the block into the phase of the current request:
+
+        with phase('hash'):
+            ...
+    '''
+    timer = _timer.get()
+    return _untimed if timer is None else _Phase(timer, name)
+
+
+def timed(name):
+    '''Decorator of sync functions, which records calls into the phase'''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+async def get_session(request):
+    with phase('session'):
+        return await aiohttp_session.get_session(request)
+
+
+async def middleware(app, handler):
+    async def process(request):
+        rate = cfg.SERVER_TIMING_SAMPLE_RATE
+        if not rate or random() >= rate:
+            return await handler(request)
+        timer = Timer()
+        token = _timer.set(timer)
+        try:
+            response = await handler(request)
+        except HTTPException as e:
+            timer.report(request, e)
+            raise
+        finally:
+            _timer.reset(token)
+        timer.report(request, response)
+        return response
+    return process
+
+
+class TimedStorage:
+    '''Storage proxy, which records calls into the `storage` phase'''
+    timed_methods = [
+        'get_user', 'create_user', 'update_user', 'delete_user',
+        'create_confirmation', 'get_confirmation', 'delete_confirmation',
+        'consume_confirmation',
+    ]
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __getattr__(self, name):
+        attr = getattr(self.storage, name)
+        if name in self.timed_methods:
+            return lambda *args, **kwargs: self._timed(attr, args, kwargs)
+        return attr
+
+    async def _timed(self, method, args, kwargs):
+        with phase('storage'):
+            return await method(*args, **kwargs)
+
+
+class Timer:
+    def __init__(self):
+        self.started = perf_counter()
+        self.phases = {}
+        # task -> [[name, started]] of its running phases, the last one is
+        # counted
+        self.stacks = {}
+
+    def enter(self, name):
+        now = perf_counter()
+        stack = self.stacks.setdefault(current_task(), [])
+        if stack:
+            self._add(stack[-1][0], now - stack[-1][1])
+        stack.append([name, now])
+        self.phases.setdefault(name, [0, 0])[1] += 1
+
+    def exit(self):
+        now = perf_counter()
+        task = current_task()
+        stack = self.stacks[task]
+        name, started = stack.pop()
+        self._add(name, now - started)
+        if stack:
+            stack[-1][1] = now
+        else:
+            del self.stacks[task]
+
+    def _add(self, name, duration):
+        self.phases[name][0] += duration
+
+    def report(self, request, response):
+        '''Adds the header to the response and logs the phases, requests
+        without phases (not the auth ones) are skipped
+        '''
+        if not self.phases:
+            return
+        total = perf_counter() - self.started
+        if not response.prepared:
+            response.headers['Server-Timing'] = server_timing(
+                self.phases, total)
+        log.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'status': response.status,
+            'total': _ms(total),
+            'phases': {name: {'dur': _ms(duration), 'calls': calls}
+                       for name, (duration, calls) in self.phases.items()},
+        }))
+
+
+def server_timing(phases, total):
+    '''
+    >>> server_timing({'session': [0.00041, 2], 'hash': [0.2512, 1]}, 0.26)
+    'session;dur=0.41, hash;dur=251.2, total;dur=260.0'
+    '''
+    metrics = ['{};dur={}'.format(name, _ms(duration))
+               for name, (duration, _) in phases.items()]
+    metrics.append('total;dur={}'.format(_ms(total)))
+    return ', '.join(metrics)
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 2)
+
+
+class _Phase:
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.timer.enter(self.name)
+
+    def __exit__(self, *args):
+        self.timer.exit()
@@ -1,35 +1,43 @@
 from os.path import join
+import asyncio
+import hashlib
 import string
 import random
+import json
+import hmac
+import time
 from logging import getLogger
 from datetime import datetime, timedelta
 from email.mime.text import MIMEText
 
 from aiohttp.web import HTTPFound
-from aiohttp_session import get_session
 from aiohttp_jinja2 import render_string
-import passlib.hash
 import aiosmtplib
 
 from .cfg import cfg
+from . import metrics
+from .timing import get_session, phase
+from .passwords import (encrypt_password, check_password,  # noqa
+                        async_encrypt_password, async_check_password,
+                        async_verify_and_update_password)
 
 
 CHARS = string.ascii_uppercase + string.ascii_lowercase + string.digits
+# random strings are used as confirmation codes and passwords, so they
+# have to be unpredictable
+system_random = random.SystemRandom()
 log = getLogger(__name__)
-
-
-def encrypt_password(password):
-    return passlib.hash.sha256_crypt.encrypt(password, rounds=1000)
-
-
-def check_password(password, password_hash):
-    return passlib.hash.sha256_crypt.verify(password, password_hash)
+MAILS = metrics.registry.histogram(
+    'aiohttp_login_mail_seconds', 'Sending of emails', ['outcome'])
+CUR_USER_LOADS = metrics.registry.counter(
+    'aiohttp_login_current_user_total',
+    'Current user loads by source: snapshot, cache or storage', ['source'])
 
 
 def get_random_string(min, max=None):
     max = max or min
-    size = random.randint(min, max)
-    return ''.join(random.choice(CHARS) for x in range(size))
+    size = system_random.randint(min, max)
+    return ''.join(system_random.choice(CHARS) for x in range(size))
 
 
 async def make_confirmation_link(request, confirmation):
@@ -49,15 +57,31 @@ async def is_confirmation_allowed(user, action):
 
 def is_confirmation_expired(confirmation):
     age = datetime.utcnow() - confirmation['created_at']
-    lifetime_days = cfg['{}_CONFIRMATION_LIFETIME'.format(
-        confirmation['action'].upper())]
-    lifetime = timedelta(days=lifetime_days)
-    return age > lifetime
+    return age > confirmation_lifetime(confirmation['action'])
+
+
+def confirmation_lifetime(action):
+    return timedelta(days=cfg['{}_CONFIRMATION_LIFETIME'.format(
+        action.upper())])
+
+
+def confirmation_cutoffs(actions):
+    '''Returns `{action: min_created_at}` of not yet expired confirmations'''
+    now = datetime.utcnow()
+    return {action: now - confirmation_lifetime(action)
+            for action in actions}
 
 
 async def authorize_user(request, user):
     session = await get_session(request)
     session[cfg.SESSION_USER_KEY] = cfg.STORAGE.user_session_id(user)
+    # storages with read replicas read the user from the primary for a while
+    pin_to_primary = getattr(cfg.STORAGE, 'pin_to_primary', None)
+    if pin_to_primary:
+        pin_to_primary(user)
+    # the snapshot is taken on the next request, the passed user could be
+    # outdated, e.g. right after activation
+    session.pop(cfg.SESSION_USER_SNAPSHOT_KEY, None)
 
 
 async def get_cur_user_id(request):
@@ -77,18 +101,142 @@ async def get_cur_user_id(request):
 
     if cfg.SESSION_USER_KEY in session:
         del session['user']
+    session.pop(cfg.SESSION_USER_SNAPSHOT_KEY, None)
 
 
 async def get_cur_user(request):
     user_id = await get_cur_user_id(request)
     if user_id:
-        user = await cfg.STORAGE.get_user({'id': user_id})
-        if not user:
+        if cfg.SESSION_USER_SNAPSHOT_TTL:
             session = await get_session(request)
+            user = user_from_snapshot(session, user_id)
+            if user:
+                CUR_USER_LOADS.inc(source='snapshot')
+                return user
+
+        cache = getattr(cfg.STORAGE, 'user_cache', None)
+        loaded_at = time.time()
+        user = cache.get(user_id) if cache else None
+        CUR_USER_LOADS.inc(source='storage' if user is None else 'cache')
+        if user is None:
+            # the user isn't cached if it's changed while loading
+            version = cache.invalidated_at(user_id) if cache else None
+            fields = cur_user_fields()
+            user = await cfg.STORAGE.get_user({'id': user_id}, fields)
+            if user and fields:
+                user = PartialUser(user)
+            if user and cache:
+                cache.set(user_id, type(user)(user), version)
+        else:
+            # handlers can change the user they got
+            user = type(user)(user)
+        session = await get_session(request)
+        if not user:
             del session['user']
+            session.pop(cfg.SESSION_USER_SNAPSHOT_KEY, None)
+        elif cfg.SESSION_USER_SNAPSHOT_TTL:
+            session[cfg.SESSION_USER_SNAPSHOT_KEY] = make_user_snapshot(
+                user, loaded_at)
         return user
 
 
+def cur_user_fields():
+    '''Fields of the current user loaded on every request, None for all'''
+    if cfg.SESSION_USER_FIELDS is None:
+        return None
+    return tuple(sorted(
+        set(cfg.SESSION_USER_FIELDS) | {'id', 'status', 'email'}))
+
+
+class PartialUser(dict):
+    '''User loaded with `SESSION_USER_FIELDS` only. Use `get_full_user()` if
+    you need the rest.
+    '''
+
+
+class UserSnapshot(PartialUser):
+    '''Partial user restored from the session snapshot: `id`, `status` and
+    `email` only
+    '''
+
+
+def make_user_snapshot(user, loaded_at):
+    '''`loaded_at` is taken before loading the user, so the snapshot isn't
+    trusted if the user changed while loading
+    '''
+    snapshot = {
+        'id': cfg.STORAGE.user_session_id(user),
+        'status': user['status'],
+        'email': user['email'],
+        'ts': loaded_at,
+    }
+    snapshot['sig'] = _sign_snapshot(snapshot)
+    return snapshot
+
+
+def user_from_snapshot(session, user_id):
+    '''Returns `UserSnapshot` if the session snapshot is trustworthy: signed
+    by us, younger than `SESSION_USER_SNAPSHOT_TTL` and taken after the
+    last known change of the user (tracked by the storage user cache)
+    '''
+    snapshot = session.get(cfg.SESSION_USER_SNAPSHOT_KEY)
+    if not isinstance(snapshot, dict):
+        return None
+    try:
+        if not hmac.compare_digest(snapshot['sig'], _sign_snapshot(snapshot)):
+            return None
+        if snapshot['id'] != session[cfg.SESSION_USER_KEY]:
+            return None
+        if time.time() - snapshot['ts'] > cfg.SESSION_USER_SNAPSHOT_TTL:
+            return None
+    except (KeyError, TypeError):
+        return None
+    cache = getattr(cfg.STORAGE, 'user_cache', None)
+    if cache and snapshot['ts'] <= cache.invalidated_at(user_id):
+        return None
+    return UserSnapshot(
+        id=user_id, status=snapshot['status'], email=snapshot['email'])
+
+
+def _sign_snapshot(snapshot):
+    payload = json.dumps([snapshot['id'], snapshot['status'],
+                          snapshot['email'], snapshot['ts']])
+    return hmac.new(_snapshot_key(), payload.encode('utf-8'),
+                    hashlib.sha256).hexdigest()
+
+
+def _snapshot_key():
+    # a key of its own, so snapshot signatures can't be mixed up with
+    # anything else signed by the csrf secret
+    return hmac.new(cfg.CSRF_SECRET.encode('utf-8'), b'user-snapshot',
+                    hashlib.sha256).digest()
+
+
+async def get_full_user(request):
+    '''Returns the current user with all the fields, even if the request
+    one is partial
+    '''
+    user = request[cfg.REQUEST_USER_KEY]
+    if isinstance(user, PartialUser):
+        user = await cfg.STORAGE.get_user({'id': user['id']})
+        request[cfg.REQUEST_USER_KEY] = user
+    return user
+
+
+class LazyUser:
+    '''Awaitable current user, loaded on the first await and memoized for
+    the rest of the request
+    '''
+    def __init__(self, request):
+        self.request = request
+        self.future = None
+
+    def __await__(self):
+        if self.future is None:
+            self.future = asyncio.ensure_future(get_cur_user(self.request))
+        return self.future.__await__()
+
+
 def url_for(urlname, *args, **kwargs):
     if str(urlname).startswith(('/', 'http://', 'https://')):
         return urlname
@@ -150,9 +298,17 @@ async def send_mail(recipient, subject, body):
 
 
 async def render_and_send_mail(request, to, template, context=None):
-    page = render_string(template, request, context)
+    with phase('render'):
+        page = render_string(template, request, context)
     subject, body = page.split('\n', 1)
-    await send_mail(to, subject.strip(), body)
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        with phase('smtp'):
+            await send_mail(to, subject.strip(), body)
+        outcome = 'sent'
+    finally:
+        MAILS.observe(time.perf_counter() - started, outcome=outcome)
 
 
 def themed(template):
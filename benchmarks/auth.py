@@ -0,0 +1,264 @@
+'''
+Measures requests per second and latency of the auth hot paths through the
+whole aiohttp stack (in-process server, real HTTP over the loopback):
+
+    python benchmarks/auth.py
+    python benchmarks/auth.py --json results.json
+    python benchmarks/auth.py --dsn postgres:///aiohttp_login_bench \\
+        --baseline results.json
+
+The in-memory storage is always measured, postgres only with `--dsn`
+(tables are recreated, so use a separate database). Mail is sent through a
+fake transport: registration includes rendering of the email, but not SMTP.
+Sessions are kept in plain cookies, so their encryption isn't counted.
+
+`--baseline` compares the results with saved ones and exits with status 1
+if requests per second dropped or p99 latency grew by more than
+`--tolerance`.
+'''
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))  # noqa
+
+from aiohttp import web, ClientSession, CookieJar, DummyCookieJar  # noqa
+from aiohttp.test_utils import TestServer  # noqa: E402
+import aiohttp_jinja2  # noqa: E402
+import jinja_app_loader  # noqa: E402
+from aiohttp_session import session_middleware, SimpleCookieStorage  # noqa
+from yarl import URL  # noqa: E402
+
+import aiohttp_login  # noqa: E402
+from aiohttp_login import login_required, restricted_api  # noqa: E402
+from aiohttp_login.utils import encrypt_password, get_random_string  # noqa
+from storages import create_memory, create_asyncpg  # noqa: E402
+
+
+CONFIG = {
+    'CSRF_SECRET': 'secret',
+    'SMTP_SENDER': 'Bench <bench@example.com>',
+    'SMTP_HOST': 'localhost',
+    'SMTP_PORT': 25,
+    'CLEANUP_INTERVAL': None,
+}
+
+
+def create_app(storage, links):
+    app = web.Application(middlewares=[
+        session_middleware(SimpleCookieStorage()),
+    ])
+    app.middlewares.append(aiohttp_login.flash.middleware)
+    aiohttp_jinja2.setup(
+        app,
+        loader=jinja_app_loader.Loader(),
+        context_processors=[aiohttp_login.flash.context_processor],
+    )
+    aiohttp_login.setup(app, storage, CONFIG)
+
+    @login_required
+    async def private(request):
+        return web.Response(text='Hello, {}'.format(request['user']['name']))
+
+    @restricted_api
+    async def api(request):
+        return {'hello': request['user']['name']}
+
+    app.router.add_get('/private', private)
+    app.router.add_get('/api/hello', api)
+
+    async def send_mail(recipient, subject, body):
+        link = body.split('<a href="')[1].split('"')[0]
+        links.append(URL(link).path_qs)
+
+    aiohttp_login.utils.send_mail = send_mail
+    return app
+
+
+class Client:
+    '''Virtual user with its own cookies'''
+    def __init__(self, server, anonymous=False):
+        self.server = server
+        self.session = ClientSession(
+            cookie_jar=DummyCookieJar() if anonymous else
+            CookieJar(unsafe=True))
+        self.csrf = None
+
+    async def request(self, method, url, **kwargs):
+        '''Returns the response status and text'''
+        async with self.session.request(
+                method, self.server.make_url(url), allow_redirects=False,
+                **kwargs) as r:
+            return r.status, await r.text()
+
+    async def login(self, storage):
+        password = get_random_string(10)
+        self.user = await storage.create_user({
+            'name': get_random_string(10),
+            'email': '{}@example.com'.format(get_random_string(20)),
+            'password': encrypt_password(password),
+            'status': 'active',
+            'created_ip': '127.0.0.1',
+        })
+        self.password = password
+        _, text = await self.request('GET', '/auth/login/')
+        self.csrf = text.split('name="csrf_token" type="hidden" value="')[
+            1].split('"')[0]
+        status, _ = await self.post_login()
+        assert status == 302, 'Login failed'
+
+    def post_login(self):
+        return self.request('POST', '/auth/login/', data={
+            'email': self.user['email'],
+            'password': self.password,
+            'csrf_token': self.csrf,
+        })
+
+    def post_registration(self):
+        password = get_random_string(10)
+        return self.request('POST', '/auth/registration/', data={
+            'email': '{}@example.com'.format(get_random_string(20)),
+            'password': password,
+            'confirm': password,
+            'csrf_token': self.csrf,
+        })
+
+    async def close(self):
+        await self.session.close()
+
+
+async def run(func, expected_status, count, clients):
+    '''Runs `func(client)` `count` times, a request per client at once'''
+    queue = iter(range(count))
+    latencies = []
+    errors = 0
+
+    async def worker(client):
+        nonlocal errors
+        for _ in queue:
+            started = time.perf_counter()
+            status, _ = await func(client)
+            latencies.append(time.perf_counter() - started)
+            if status != expected_status:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker(client) for client in clients])
+    elapsed = time.perf_counter() - started
+    return {
+        'count': count,
+        'errors': errors,
+        'rps': round(count / elapsed, 1),
+        'p50_ms': percentile(latencies, 0.5),
+        'p99_ms': percentile(latencies, 0.99),
+    }
+
+
+def percentile(values, share):
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * share))
+    return round(values[index] * 1000, 3)
+
+
+async def bench(storage, count, concurrency):
+    links = []
+    server = TestServer(create_app(storage, links))
+    await server.start_server()
+    anonymous = [Client(server, anonymous=True) for _ in range(concurrency)]
+    clients = [Client(server) for _ in range(concurrency)]
+    for client in clients:
+        await client.login(storage)
+
+    def confirm(client):
+        return client.request('GET', links.pop())
+
+    scenarios = [
+        ('login_page', lambda client: client.request('GET', '/auth/login/'),
+         200, anonymous),
+        ('login', Client.post_login, 302, clients),
+        ('login_required', lambda client: client.request('GET', '/private'),
+         200, clients),
+        ('restricted_api', lambda client: client.request('GET', '/api/hello'),
+         200, clients),
+        ('registration', Client.post_registration, 302, clients),
+        ('confirmation', confirm, 302, anonymous),
+    ]
+    results = {}
+    try:
+        for name, func, status, scenario_clients in scenarios:
+            results[name] = result = await run(
+                func, status, min(count, len(links)) if func is confirm
+                else count, scenario_clients)
+            print('  {:<16} {:>8.0f} req/s  p50 {:>7.2f} ms  '
+                  'p99 {:>7.2f} ms  errors {}'.format(
+                      name, result['rps'], result['p50_ms'],
+                      result['p99_ms'], result['errors']),
+                  file=sys.stderr)
+    finally:
+        for client in anonymous + clients:
+            await client.close()
+        await server.close()
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    for storage, scenarios in results['storages'].items():
+        for name, result in scenarios.items():
+            base = baseline['storages'].get(storage, {}).get(name)
+            if not base:
+                continue
+            if result['rps'] < base['rps'] * (1 - tolerance):
+                yield '{} {}: {} req/s, was {}'.format(
+                    storage, name, result['rps'], base['rps'])
+            if result['p99_ms'] > base['p99_ms'] * (1 + tolerance):
+                yield '{} {}: p99 {} ms, was {}'.format(
+                    storage, name, result['p99_ms'], base['p99_ms'])
+
+
+async def main(args):
+    backends = [('memory', create_memory, None)]
+    if args.dsn:
+        backends.append(('asyncpg', create_asyncpg, args.dsn))
+    results = {
+        'python': platform.python_version(),
+        'count': args.count,
+        'concurrency': args.concurrency,
+        'storages': {},
+    }
+    for name, create, target in backends:
+        storage = await create(target)
+        print('{} (concurrency {}):'.format(name, args.concurrency),
+              file=sys.stderr)
+        results['storages'][name] = await bench(
+            storage, args.count, args.concurrency)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--dsn', help='postgres dsn')
+    parser.add_argument('--count', type=int, default=1000,
+                        help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--json', help='save results to the file')
+    parser.add_argument('--baseline', help='compare with saved results')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+    results = asyncio.get_event_loop().run_until_complete(main(args))
+
+    output = json.dumps(results, indent=2)
+    if args.json:
+        Path(args.json).write_text(output)
+    else:
+        print(output)
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        found = list(regressions(results, baseline, args.tolerance))
+        for regression in found:
+            print('Regression: ' + regression, file=sys.stderr)
+        sys.exit(1 if found else 0)
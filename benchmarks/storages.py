@@ -0,0 +1,114 @@
+'''
+Compares throughput of storage backends on the auth hot paths:
+
+    python benchmarks/storages.py --sqlite /tmp/bench.sqlite
+    python benchmarks/storages.py --sqlite /tmp/bench.sqlite \\
+        --dsn postgres:///aiohttp_login_bench
+
+Tables are (re)created by the benchmark, so use a separate database.
+'''
+import sys
+import time
+import sqlite3
+import asyncio
+import argparse
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))  # noqa
+
+from aiohttp_login.utils import get_random_string  # noqa: E402
+
+
+async def create_sqlite(path):
+    from aiohttp_login.sqlite_storage import SqliteStorage
+    with sqlite3.connect(path) as conn:
+        conn.executescript((ROOT / 'aiohttp_login/sqlite_tables.sql')
+                           .read_text())
+    storage = SqliteStorage(path)
+    await storage.connect()
+    return storage
+
+
+async def create_asyncpg(dsn):
+    import asyncpg
+    from aiohttp_login.asyncpg_storage import AsyncpgStorage
+    conn = await asyncpg.connect(dsn)
+    await conn.execute((ROOT / 'aiohttp_login/pg_tables.sql').read_text())
+    await conn.close()
+    return AsyncpgStorage(await asyncpg.create_pool(dsn))
+
+
+async def create_memory(_):
+    from aiohttp_login.memory_storage import InMemoryStorage
+    return InMemoryStorage()
+
+
+def user_data():
+    return {
+        'name': get_random_string(10),
+        'email': '{}@example.com'.format(get_random_string(20)),
+        'password': get_random_string(40),
+        'status': 'confirmation',
+        'created_ip': '127.0.0.1',
+    }
+
+
+async def run(name, func, count, concurrency):
+    '''Runs `func(i)` `count` times, `concurrency` calls at once'''
+    queue = iter(range(count))
+
+    async def worker():
+        for i in queue:
+            await func(i)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    print('  {:<28} {:>10.0f} ops/s'.format(name, count / elapsed))
+
+
+async def bench(storage, count, concurrency):
+    users = [await storage.create_user(user_data()) for _ in range(100)]
+
+    async def register(i):
+        user = await storage.create_user(user_data())
+        await storage.create_confirmation(user, 'registration')
+
+    async def get_by_id(i):
+        user = users[i % len(users)]
+        await storage.get_user({'id': user.get('id', user.get('_id'))})
+
+    async def get_by_email(i):
+        await storage.get_user({'email': users[i % len(users)]['email']})
+
+    async def update(i):
+        await storage.update_user(users[i % len(users)], {'name': str(i)})
+
+    await run('register', register, count, concurrency)
+    await run('get_user by id', get_by_id, count, concurrency)
+    await run('get_user by email', get_by_email, count, concurrency)
+    await run('update_user', update, count, concurrency)
+
+
+async def main(args):
+    backends = [('memory', create_memory, None)]
+    if args.sqlite:
+        backends.append(('sqlite', create_sqlite, args.sqlite))
+    if args.dsn:
+        backends.append(('asyncpg', create_asyncpg, args.dsn))
+    for name, create, target in backends:
+        storage = await create(target)
+        print('{} (concurrency {}):'.format(name, args.concurrency))
+        await bench(storage, args.count, args.concurrency)
+        if hasattr(storage, 'on_cleanup'):
+            await storage.on_cleanup(None)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sqlite', help='sqlite database path')
+    parser.add_argument('--dsn', help='postgres dsn')
+    parser.add_argument('--count', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
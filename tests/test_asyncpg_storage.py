@@ -0,0 +1,127 @@
+'''
+Connection pinning of `AsyncpgStorage`.
+Instrumentation of its pools runs on a fake pool.
+'''
+import asyncio
+
+import pytest
+
+from utils import *  # noqa
+from test_storage import new_user_data
+from aiohttp_login.asyncpg_storage import AsyncpgStorage, init_connection
+from aiohttp_login.cache import UserCache
+from aiohttp_login.instrumentation import InstrumentedStorage
+from aiohttp_login.metrics import Registry
+
+
+@pytest.fixture
+def pg_storage(loop):
+    yield from storage_of(loop, 'asyncpg')
+
+
+async def test_pinned_transaction_rollback(pg_storage):
+    data = new_user_data()
+    with pytest.raises(ZeroDivisionError):
+        async with pg_storage.pinned(transaction=True):
+            await pg_storage.create_user(data)
+            assert await pg_storage.get_user({'email': data['email']})
+            1 / 0
+    assert not await pg_storage.get_user({'email': data['email']})
+
+
+async def test_failed_statement_rolls_back_to_savepoint(pg_storage):
+    taken = await pg_storage.create_user(new_user_data())
+    users = [new_user_data(), new_user_data(email=taken['email'])]
+    async with pg_storage.pinned(transaction=True):
+        errors = await pg_storage.bulk_create_users(users)
+        assert [index for index, _ in errors] == [1]
+        # the transaction isn't aborted
+        user = await pg_storage.get_user({'email': users[0]['email']})
+        await pg_storage.create_confirmation(user, 'registration')
+    user = await pg_storage.get_user({'email': users[0]['email']})
+    assert user
+    await pg_storage.delete_user(user)
+    await pg_storage.delete_user(taken)
+
+
+async def test_pinned_connection_takes_turns(pg_storage):
+    user = await pg_storage.create_user(new_user_data())
+    async with pg_storage.pinned(transaction=True):
+        found = await asyncio.gather(*[
+            pg_storage.get_user({'id': user['id']}) for _ in range(5)])
+    assert [u['id'] for u in found] == [user['id']] * 5
+    await pg_storage.delete_user(user)
+
+
+async def test_cache_invalidated_after_commit(pg_storage, monkeypatch):
+    monkeypatch.setattr(pg_storage, 'user_cache', UserCache())
+    user = await pg_storage.create_user(new_user_data())
+    pg_storage.user_cache.set(user['id'], user)
+    async with pg_storage.pinned(transaction=True):
+        await pg_storage.update_user(user, {'name': 'changed'})
+        assert pg_storage.user_cache.get(user['id'])
+    assert pg_storage.user_cache.get(user['id']) is None
+    await pg_storage.delete_user(user)
+
+
+async def test_pinned_conn_without_transaction(pg_storage):
+    async with pg_storage.pinned() as conn:
+        assert not conn.is_in_transaction()
+        user = await pg_storage.create_user(new_user_data())
+    # written right away
+    assert await pg_storage.get_user({'id': user['id']})
+    await pg_storage.delete_user(user)
+
+
+class FakePool:
+    def acquire(self):
+        return FakeAcquire()
+
+
+class FakeAcquire:
+    async def __aenter__(self):
+        return FakeConnection()
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.statements = []
+
+    async def fetchrow(self, statement, *args):
+        self.statements.append(statement)
+        return None
+
+
+async def test_pool_wait_labels(loop):
+    pool = FakePool()
+    registry = Registry()
+    storage = InstrumentedStorage(AsyncpgStorage(pool), registry)
+    await storage.get_user({'email': 'foo@bar.com'})
+    await storage.get_user({'id': 1})
+    # the storage itself isn't changed
+    assert storage.storage.pool is pool
+    waits = registry.metrics[
+        'aiohttp_login_storage_pool_wait_seconds'].samples()
+    assert sorted(waits) == [('get_user', 'email', 'primary'),
+                             ('get_user', 'id', 'primary')]
+
+
+async def test_init_connection(loop, monkeypatch):
+    cfg.configure(dict(CONFIG, APP=None, STORAGE=None))
+    conn = FakeConnection()
+    await init_connection(conn, user_table_name='accounts')
+    assert len(conn.statements) == 3
+    assert 'accounts' in conn.statements[0]
+
+    # connections opened before the setup are left to `warm_up`
+    monkeypatch.setattr(cfg, 'configured', False)
+    conn = FakeConnection()
+    await init_connection(conn)
+    assert conn.statements == []
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '--maxfail=1'])
@@ -0,0 +1,79 @@
+import csv
+import json
+
+from utils import *  # noqa
+from aiohttp_login import bulk_import
+from aiohttp_login.utils import get_random_string
+
+
+def new_email():
+    return '{}@gmail.com'.format(get_random_string(10))
+
+
+async def delete_users(storage, emails):
+    for email in emails:
+        user = await storage.get_user({'email': email})
+        if user:
+            await storage.delete_user(user)
+
+
+async def test_import_users(storage):
+    taken = await storage.create_user({
+        'name': 'taken', 'email': new_email(), 'password': 'hash',
+        'status': 'active', 'created_ip': ''})
+    good = [new_email(), new_email()]
+    rows = [
+        {'email': good[0], 'password_hash': 'hash'},
+        {'email': taken['email'], 'password_hash': 'hash'},
+        {'email': 'wrong-email', 'password_hash': 'hash'},
+        {'email': good[1], 'password': 'secret', 'name': 'foo'},
+    ]
+    errors = []
+    stats = await bulk_import.import_users(storage, rows, errors=errors)
+    assert stats['imported'] == 2
+    assert stats['failed'] == 2
+    assert sorted(error['row'] for error in errors) == [2, 3]
+
+    user = await storage.get_user({'email': good[1]})
+    assert user['name'] == 'foo'
+    assert user['created_at']
+    assert bulk_import.CryptContext(
+        **bulk_import.DEFAULTS['PASSWORD_CONTEXT']).verify(
+            'secret', user['password'])
+    await delete_users(storage, good + [taken['email']])
+
+
+async def test_import_users_cli(storage, tmp_path, monkeypatch):
+    async def create_storage(args):
+        return storage
+
+    monkeypatch.setattr(bulk_import, '_create_storage', create_storage)
+    emails = [new_email(), new_email()]
+    path = tmp_path / 'users.csv'
+    with open(str(path), 'w', newline='') as f:
+        writer = csv.DictWriter(f, ['email', 'password_hash'])
+        writer.writeheader()
+        writer.writerow({'email': emails[0], 'password_hash': 'hash'})
+        writer.writerow({'email': emails[1], 'password_hash': ''})
+    errors_path = tmp_path / 'errors.jsonl'
+
+    stats = await bulk_import._main(bulk_import.parse_args([
+        str(path), '--dsn', 'postgres:///unused',
+        '--errors', str(errors_path)]))
+    assert stats['imported'] == 1
+    errors = [json.loads(line)
+              for line in errors_path.read_text().splitlines()]
+    assert errors == [{'row': 2, 'email': emails[1], 'error': 'No password'}]
+    await delete_users(storage, emails)
+
+
+def test_read_rows(tmp_path):
+    path = tmp_path / 'users.jsonl'
+    path.write_text('{"email": "foo@bar.com"}\n\n{"email": "baz@bar.com"}\n')
+    assert [row['email'] for row in bulk_import.read_rows(str(path))] == [
+        'foo@bar.com', 'baz@bar.com']
+
+
+if __name__ == '__main__':
+    import pytest
+    pytest.main([__file__, '--maxfail=1'])
@@ -1,4 +1,4 @@
-from utils import log_client_in
+from utils import log_client_in, set_user_cache
 from utils import *  # noqa
 from aiohttp_login import cfg, url_for
 
@@ -20,6 +20,106 @@ async def test_restricred_api(client):
     await cfg.STORAGE.delete_user(user)
 
 
+async def test_lazy_user_to_request(client):
+    url = url_for('lazy_user')
+    r = await client.get(url)
+    assert (await r.json()) == {'email': None}
+
+    user = await log_client_in(client)
+
+    r = await client.get(url)
+    assert (await r.json()) == {'email': user['email']}
+
+    await cfg.STORAGE.delete_user(user)
+
+
+async def test_user_snapshot(client, monkeypatch):
+    monkeypatch.setitem(cfg, 'SESSION_USER_SNAPSHOT_TTL', 60)
+    api_url = url_for('api_hello')
+    user = await log_client_in(client)
+
+    # the first request takes the snapshot
+    r = await client.get(api_url)
+    assert r.status == 200
+
+    async def get_user(filter, fields=None):
+        assert 0, 'user should be taken from the snapshot'
+    monkeypatch.setattr(cfg.STORAGE, 'get_user', get_user)
+
+    r = await client.get(api_url)
+    assert r.status == 200
+
+    monkeypatch.undo()
+    await cfg.STORAGE.delete_user(user)
+
+
+async def test_user_fields(client, monkeypatch):
+    monkeypatch.setitem(cfg, 'SESSION_USER_FIELDS', [])
+    user = await log_client_in(client)
+
+    get_user = cfg.STORAGE.get_user
+    loaded_fields = []
+
+    async def get_user_spy(filter, fields=None):
+        loaded_fields.append(fields)
+        return await get_user(filter, fields)
+    monkeypatch.setattr(cfg.STORAGE, 'get_user', get_user_spy)
+
+    r = await client.get(url_for('lazy_user'))
+    assert (await r.json()) == {'email': user['email']}
+    assert loaded_fields == [('email', 'id', 'status')]
+
+    monkeypatch.undo()
+    await cfg.STORAGE.delete_user(user)
+
+
+async def test_user_cache(client, monkeypatch):
+    cache = set_user_cache(monkeypatch)
+    user = await log_client_in(client)
+    url = url_for('lazy_user')
+
+    # cached by the redirect after login
+    hits = cache.hits
+    r = await client.get(url)
+    assert (await r.json()) == {'email': user['email']}
+    assert cache.hits == hits + 1
+
+    email = 'changed-' + user['email']
+    await cfg.STORAGE.update_user(user, {'email': email})
+    assert cache.get(user['id']) is None
+    misses = cache.misses
+    r = await client.get(url)
+    assert (await r.json()) == {'email': email}
+    assert cache.misses == misses + 1
+    assert cache.get(user['id'])['email'] == email
+
+    monkeypatch.undo()
+    await cfg.STORAGE.delete_user(user)
+
+
+async def test_user_cache_update_while_loading(client, monkeypatch):
+    cache = set_user_cache(monkeypatch)
+    user = await log_client_in(client)
+    cache.invalidate(user['id'])
+
+    get_user = cfg.STORAGE.get_user
+    email = 'changed-' + user['email']
+
+    async def get_user_updated_meanwhile(filter, fields=None):
+        loaded = await get_user(filter, fields)
+        await cfg.STORAGE.update_user(user, {'email': email})
+        return loaded
+    monkeypatch.setattr(cfg.STORAGE, 'get_user', get_user_updated_meanwhile)
+
+    r = await client.get(url_for('lazy_user'))
+    assert (await r.json()) == {'email': user['email']}
+    # the outdated user isn't cached
+    assert cache.get(user['id']) is None
+
+    monkeypatch.undo()
+    await cfg.STORAGE.delete_user(user)
+
+
 if __name__ == '__main__':
     import pytest
     pytest.main([__file__, '--maxfail=1'])
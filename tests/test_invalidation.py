@@ -0,0 +1,136 @@
+'''
+Invalidation buses without a database: `PgInvalidationBus` runs on a fake
+pool, which records the statements
+'''
+import asyncio
+
+import pytest
+
+from aiohttp_login.cache import UserCache
+from aiohttp_login.invalidation import LocalInvalidationBus, PgInvalidationBus
+from aiohttp_login.memory_storage import InMemoryStorage
+
+
+class FakeConnection:
+    def __init__(self):
+        self.executed = []
+        self.listeners = {}
+        self.termination_listeners = []
+        self.closed = False
+
+    async def execute(self, query, *args):
+        self.executed.append((query,) + args)
+
+    async def add_listener(self, channel, callback):
+        self.listeners[channel] = callback
+
+    async def remove_listener(self, channel, callback):
+        del self.listeners[channel]
+
+    def add_termination_listener(self, callback):
+        self.termination_listeners.append(callback)
+
+    def remove_termination_listener(self, callback):
+        self.termination_listeners.remove(callback)
+
+    def is_closed(self):
+        return self.closed
+
+    def notify(self, channel, payload):
+        self.listeners[channel](self, 1, channel, payload)
+
+    def terminate(self):
+        self.closed = True
+        for callback in self.termination_listeners:
+            callback(self)
+
+
+class FakePool:
+    def __init__(self):
+        self.connections = []
+        self.released = []
+
+    async def acquire(self):
+        conn = FakeConnection()
+        self.connections.append(conn)
+        return conn
+
+    async def release(self, conn):
+        self.released.append(conn)
+
+
+async def test_local_bus_evicts_other_nodes(loop):
+    bus = LocalInvalidationBus()
+    nodes = [InMemoryStorage(user_cache=UserCache(), invalidation_bus=bus)
+             for _ in range(2)]
+    user = await nodes[0].create_user({'email': 'foo@bar.com'})
+    for node in nodes:
+        node.user_cache.set(user['id'], dict(user))
+    await nodes[0].update_user(user, {'name': 'foo'})
+    assert [node.user_cache.get(user['id']) for node in nodes] == [None, None]
+
+
+async def test_pg_bus_delivers_notifications(loop):
+    pool = FakePool()
+    bus = PgInvalidationBus(pool)
+    storage = InMemoryStorage(user_cache=UserCache(), invalidation_bus=bus)
+    await bus.start()
+    conn, = pool.connections
+    storage.user_cache.set(42, {'id': 42})
+    conn.notify(bus.channel, '42')
+    assert storage.user_cache.get(42) is None
+
+    # published through the listening connection, not a new one
+    await bus.publish('7')
+    assert pool.connections == [conn]
+    assert conn.executed == [('SELECT pg_notify($1, $2)', bus.channel, '7')]
+
+    await bus.stop()
+    assert pool.released == [conn]
+    assert not conn.listeners and not conn.termination_listeners
+
+
+async def test_pg_bus_reconnects(loop):
+    pool = FakePool()
+    bus = PgInvalidationBus(pool)
+    storage = InMemoryStorage(user_cache=UserCache(), invalidation_bus=bus)
+    await bus.start()
+    lost, = pool.connections
+    storage.user_cache.set(42, {'id': 42})
+
+    lost.terminate()
+    await bus.reconnecting
+    assert pool.released == [lost]
+    conn = pool.connections[-1]
+    assert conn is not lost and bus.channel in conn.listeners
+    # notifications could be missed meanwhile
+    assert storage.user_cache.get(42) is None
+
+    storage.user_cache.set(7, {'id': 7})
+    conn.notify(bus.channel, '7')
+    assert storage.user_cache.get(7) is None
+    await bus.stop()
+
+
+async def test_pg_bus_retries_to_listen(loop, monkeypatch):
+    pool = FakePool()
+    bus = PgInvalidationBus(pool, reconnect_delay=0)
+    await bus.start()
+    acquire = pool.acquire
+    attempts = []
+
+    async def failing_acquire():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ConnectionError
+        return await acquire()
+
+    monkeypatch.setattr(pool, 'acquire', failing_acquire)
+    pool.connections[0].terminate()
+    await asyncio.wait_for(bus.reconnecting, 1)
+    assert len(attempts) == 3 and bus.conn is pool.connections[-1]
+    await bus.stop()
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '--maxfail=1'])
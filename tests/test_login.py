@@ -1,6 +1,6 @@
 from utils import get_csrf, NewUser
 from utils import *  # noqa
-from aiohttp_login import cfg, url_for
+from aiohttp_login import cfg, url_for, passwords
 
 
 EMAIL, PASSWORD = 'tester@test.com', 'password'
@@ -105,6 +105,104 @@ async def test_login_successfully(client):
     assert cfg.MSG_LOGGED_IN in await r.text()
 
 
+async def test_login_rehashes_outdated_password(client, monkeypatch):
+    url = url_for('auth_login')
+    r = await client.get(url)
+    async with NewUser() as user:
+        monkeypatch.setitem(cfg, 'PASSWORD_CONTEXT', {
+            'schemes': ['sha256_crypt'],
+            'sha256_crypt__default_rounds': 2000,
+            'sha256_crypt__min_rounds': 2000,
+        })
+        r = await client.post(url, data={
+            'email': user['email'],
+            'password': user['raw_password'],
+            'csrf_token': await get_csrf(r),
+        })
+        assert cfg.MSG_LOGGED_IN in await r.text()
+        user = await cfg.STORAGE.get_user({'email': user['email']})
+        assert '$rounds=2000$' in user['password']
+
+
+async def test_login_doesnt_rehash_for_banned(client, monkeypatch):
+    url = url_for('auth_login')
+    r = await client.get(url)
+    async with NewUser({'status': 'banned'}) as user:
+        monkeypatch.setitem(cfg, 'PASSWORD_CONTEXT', {
+            'schemes': ['sha256_crypt'],
+            'sha256_crypt__default_rounds': 2000,
+            'sha256_crypt__min_rounds': 2000,
+        })
+        r = await client.post(url, data={
+            'email': user['email'],
+            'password': user['raw_password'],
+            'csrf_token': await get_csrf(r),
+        })
+        assert cfg.MSG_USER_BANNED in await r.text()
+        found = await cfg.STORAGE.get_user({'email': user['email']})
+        assert found['password'] == user['password']
+
+
+async def check_login_overloaded(client):
+    url = url_for('auth_login')
+    r = await client.get(url)
+    passwords._get_executor()
+    admission = passwords.admission
+    limits = admission.max_in_flight, admission.max_queue
+    rejected = admission.rejected
+    admission.configure(1, 0)
+    try:
+        async with NewUser() as user:
+            async with admission:
+                r = await client.post(url, data={
+                    'email': user['email'],
+                    'password': user['raw_password'],
+                    'csrf_token': await get_csrf(r),
+                })
+    finally:
+        admission.configure(*limits)
+    assert r.status == 503
+    assert 'Retry-After' in r.headers
+    assert admission.rejected == rejected + 1
+
+
+async def test_login_overloaded(client):
+    await check_login_overloaded(client)
+
+
+async def test_login_overloaded_without_executor(client, monkeypatch):
+    monkeypatch.setitem(cfg, 'PASSWORD_HASH_EXECUTOR', None)
+    await passwords.shutdown()
+    await check_login_overloaded(client)
+
+
+async def test_login_with_email_in_other_case(client):
+    url = url_for('auth_login')
+    r = await client.get(url)
+    async with NewUser() as user:
+        r = await client.post(url, data={
+            'email': user['email'].upper(),
+            'password': user['raw_password'],
+            'csrf_token': await get_csrf(r),
+        })
+    assert cfg.MSG_LOGGED_IN in await r.text()
+
+
+async def test_login_metrics(client):
+    url = url_for('auth_login')
+    r = await client.get(url)
+    r = await client.post(url, data={
+        'email': 'unknown@email.com',
+        'password': 'wrong.',
+        'csrf_token': await get_csrf(r),
+    })
+    r = await client.get(url_for('auth_metrics'))
+    assert r.status == 200
+    assert r.headers['Content-Type'].startswith('text/plain')
+    assert ('aiohttp_login_login_seconds_count{outcome="unknown_email"}'
+            in await r.text())
+
+
 if __name__ == '__main__':
     import pytest
     pytest.main([__file__, '--maxfail=1'])
@@ -0,0 +1,25 @@
+import logging
+
+from passlib.context import CryptContext
+
+from utils import CONFIG
+from aiohttp_login import cfg, passwords
+
+
+def test_calibrate_within_configured_rounds(caplog):
+    cfg.configure(dict(CONFIG, APP=None, STORAGE=None, PASSWORD_CONTEXT={
+        'schemes': ['sha256_crypt'],
+        'sha256_crypt__min_rounds': 20000,
+        'sha256_crypt__default_rounds': 20000,
+    }))
+    with caplog.at_level(logging.WARNING, logger=passwords.__name__):
+        result = passwords.calibrate(0.00001, samples=1)
+    # the target would need fewer rounds than allowed
+    assert result['rounds'] == 20000
+    assert 'out of the allowed' in caplog.text
+    CryptContext(**cfg.PASSWORD_CONTEXT)
+
+
+if __name__ == '__main__':
+    import pytest
+    pytest.main([__file__, '--maxfail=1'])
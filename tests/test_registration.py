@@ -1,6 +1,8 @@
-from utils import get_csrf, NewUser, parse_link
+import asyncio
+
+from utils import get_csrf, NewUser, parse_link, create_user, set_user_cache
 from utils import *  # noqa
-from aiohttp_login import cfg, url_for
+from aiohttp_login import cfg, url_for, sweeper
 
 
 EMAIL, PASSWORD = 'tester@test.com', 'password'
@@ -109,10 +111,43 @@ async def test_registration_with_confirmation(client, capsys):
     user = await db.get_user({'email': EMAIL})
     assert user['status'] == 'active'
 
+    # the link is consumed
+    r = await client.get(link)
+    assert 'The link is wrong or expired' in await r.text()
+
     user = await db.get_user({'email': EMAIL})
     await db.delete_user(user)
 
 
+async def test_sweeper_removes_abandoned_registrations(client, monkeypatch):
+    db = cfg.STORAGE
+    cache = set_user_cache(monkeypatch)
+    user = await create_user({'status': 'confirmation'})
+    user_id = db.user_id_from_string(db.user_session_id(user))
+    await db.create_confirmation(user, 'registration')
+    assert await sweeper.sweep() == (0, 0)
+
+    cache.set(user_id, user)
+    monkeypatch.setitem(cfg, 'REGISTRATION_CONFIRMATION_LIFETIME', -1)
+    assert await sweeper.sweep(batch_size=1) == (1, 1)
+    assert not await db.get_user({'email': user['email']})
+    assert not await db.get_confirmation({'user': user})
+    assert cache.get(user_id) is None
+
+
+async def test_sweeper_task(client, monkeypatch):
+    # disabled by default
+    assert sweeper.APP_KEY not in client.app
+
+    monkeypatch.setitem(cfg, 'CLEANUP_INTERVAL', 3600)
+    await sweeper.start(client.app)
+    task = client.app[sweeper.APP_KEY]
+    await asyncio.sleep(0)
+    assert not task.done()
+    await sweeper.stop(client.app)
+    assert task.cancelled()
+
+
 if __name__ == '__main__':
     import pytest
     pytest.main([__file__, '--maxfail=1'])
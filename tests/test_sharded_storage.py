@@ -0,0 +1,97 @@
+'''
+Email index of `ShardedStorage`
+'''
+from datetime import timedelta
+
+import pytest
+
+from utils import *  # noqa
+from test_storage import new_user_data, cutoffs
+from aiohttp_login.memory_storage import DuplicateKeyError
+
+
+@pytest.fixture
+def sharded_storage(loop):
+    yield from storage_of(loop, 'sharded')
+
+
+async def test_session_id_and_code_routing(sharded_storage):
+    users = {}
+    while len(users) < 2:
+        user = await sharded_storage.create_user(new_user_data())
+        users.setdefault(user['id'].shard, user)
+    for shard, user in users.items():
+        session_id = sharded_storage.user_session_id(user)
+        assert session_id == '{}:{}'.format(shard, user['id'].id)
+        found = await sharded_storage.get_user(
+            {'id': sharded_storage.user_id_from_string(session_id)})
+        assert found['email'] == user['email']
+
+        confirmation = await sharded_storage.create_confirmation(
+            user, 'reset_password')
+        assert confirmation['code'].startswith('{}.'.format(shard))
+        found = await sharded_storage.get_confirmation(
+            {'code': confirmation['code']})
+        assert found['user_id'] == user['id']
+        await sharded_storage.delete_confirmation(confirmation)
+        await sharded_storage.delete_user(user)
+
+
+async def test_failed_shard_insert_releases_email(sharded_storage,
+                                                  monkeypatch):
+    data = new_user_data()
+    shard = sharded_storage.shards[sharded_storage.shard_for_email(
+        data['email'])]
+
+    async def create_user(data):
+        raise ConnectionError
+    monkeypatch.setattr(shard, 'create_user', create_user)
+    with pytest.raises(ConnectionError):
+        await sharded_storage.create_user(dict(data))
+    assert await sharded_storage.index.find_shard(data['email']) is None
+
+    monkeypatch.undo()
+    user = await sharded_storage.create_user(data)
+    assert await sharded_storage.get_user({'email': data['email']})
+    await sharded_storage.delete_user(user)
+
+
+async def test_failed_index_update_removes_user(sharded_storage,
+                                                monkeypatch):
+    data = new_user_data()
+
+    async def set_user_id(email, user_id):
+        raise ConnectionError
+    monkeypatch.setattr(sharded_storage.index, 'set_user_id', set_user_id)
+    with pytest.raises(ConnectionError):
+        await sharded_storage.create_user(data)
+    assert await sharded_storage.index.find_shard(data['email']) is None
+    for shard in sharded_storage.shards:
+        assert not await shard.get_user({'email': data['email']})
+
+
+async def test_change_email_to_taken_one(sharded_storage):
+    user = await sharded_storage.create_user(new_user_data())
+    email = new_user_data()['email']
+    confirmation = await sharded_storage.create_confirmation(
+        user, 'change_email', email)
+
+    # not consumed, the new email is released
+    assert await sharded_storage.consume_confirmation(
+        confirmation['code'], cutoffs(age=timedelta(0))) == (None, None)
+    other = await sharded_storage.create_user(new_user_data(email=email))
+
+    with pytest.raises(DuplicateKeyError):
+        await sharded_storage.consume_confirmation(
+            confirmation['code'], cutoffs())
+    found = await sharded_storage.get_user({'email': user['email']})
+    assert found['id'] == user['id']
+    found = await sharded_storage.get_user({'email': email})
+    assert found['id'] == other['id']
+    await sharded_storage.delete_confirmation(confirmation)
+    await sharded_storage.delete_user(user)
+    await sharded_storage.delete_user(other)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '--maxfail=1'])
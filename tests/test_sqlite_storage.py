@@ -0,0 +1,25 @@
+'''
+Specifics of `SqliteStorage`
+'''
+import asyncio
+import sqlite3
+
+import pytest
+
+from utils import *  # noqa
+
+
+@pytest.fixture
+def sqlite_storage(loop):
+    yield from storage_of(loop, 'sqlite')
+
+
+async def test_confirmation_of_unknown_user(sqlite_storage):
+    # only code collisions are retried
+    with pytest.raises(sqlite3.IntegrityError, match='FOREIGN KEY'):
+        await asyncio.wait_for(sqlite_storage.create_confirmation(
+            {'id': 10 ** 9}, 'registration'), 5)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '--maxfail=1'])
@@ -0,0 +1,243 @@
+'''
+Conformance tests every storage has to pass
+'''
+import asyncio
+import sqlite3
+from datetime import datetime, timedelta
+
+import asyncpg
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+from utils import *  # noqa
+from aiohttp_login.utils import get_random_string
+from aiohttp_login.motor_storage import MotorStorage
+from aiohttp_login.metrics import Registry
+from aiohttp_login.instrumentation import InstrumentedStorage
+from aiohttp_login.coalescing import CoalescingStorage
+from aiohttp_login import memory_storage
+
+
+# errors of unique indexes: asyncpg, motor, memory (and sharded), sqlite
+DUPLICATE_ERRORS = (asyncpg.UniqueViolationError, DuplicateKeyError,
+                    memory_storage.DuplicateKeyError, sqlite3.IntegrityError)
+FOREIGN_KEY_ERRORS = (asyncpg.ForeignKeyViolationError,
+                      memory_storage.ForeignKeyError, sqlite3.IntegrityError)
+
+
+def new_user_data(**data):
+    user = {
+        'name': get_random_string(10),
+        'email': '{}@gmail.com'.format(get_random_string(10)),
+        'password': 'hash',
+        'status': 'active',
+        'created_ip': '127.0.0.1',
+    }
+    user.update(data)
+    return user
+
+
+def user_id(storage, user):
+    return storage.user_id_from_string(storage.user_session_id(user))
+
+
+def cutoffs(age=timedelta(days=1)):
+    min_created_at = datetime.utcnow() - age
+    return {action: min_created_at for action in
+            ['registration', 'reset_password', 'change_email']}
+
+
+async def test_get_user(storage):
+    user = await storage.create_user(new_user_data(google='g1'))
+    uid = user_id(storage, user)
+
+    found = await storage.get_user({'id': uid})
+    assert found['email'] == user['email']
+    assert user_id(storage, found) == uid
+    found = await storage.get_user({'email': user['email'].upper()})
+    assert user_id(storage, found) == uid
+    found = await storage.get_user({'google': 'g1'})
+    assert user_id(storage, found) == uid
+
+    assert not await storage.get_user({'email': 'unknown@gmail.com'})
+    assert not await storage.get_user({'facebook': 'unknown'})
+    await storage.delete_user(user)
+
+
+async def test_get_user_fields(storage):
+    user = await storage.create_user(new_user_data())
+    uid = user_id(storage, user)
+    found = await storage.get_user({'id': uid}, ('email', 'id', 'status'))
+    assert found['id'] == uid
+    assert found['email'] == user['email']
+    assert found['status'] == 'active'
+    assert 'name' not in found
+    await storage.delete_user(user)
+
+
+async def test_email_is_unique(storage):
+    user = await storage.create_user(new_user_data())
+    data = new_user_data(email=user['email'])
+    with pytest.raises(DUPLICATE_ERRORS):
+        await storage.create_user(data)
+    assert 'id' not in data
+    await storage.delete_user(user)
+
+
+async def test_update_and_delete_user(storage):
+    user = await storage.create_user(new_user_data())
+    email = new_user_data()['email']
+    await storage.update_user(user, {'email': email, 'name': 'foo'})
+    assert not await storage.get_user({'email': user['email']})
+    found = await storage.get_user({'email': email})
+    assert found['name'] == 'foo'
+
+    await storage.delete_user(found)
+    assert not await storage.get_user({'id': user_id(storage, user)})
+
+
+async def test_bulk_create_users(storage):
+    taken = await storage.create_user(new_user_data())
+    users = [new_user_data(), new_user_data(email=taken['email']),
+             new_user_data()]
+    errors = await storage.bulk_create_users(users)
+    assert [index for index, _ in errors] == [1]
+    for data in [users[0], users[2]]:
+        user = await storage.get_user({'email': data['email']})
+        await storage.delete_user(user)
+    await storage.delete_user(taken)
+
+
+async def test_confirmations(storage):
+    user = await storage.create_user(new_user_data())
+    first = await storage.create_confirmation(user, 'reset_password')
+    confirmation = await storage.create_confirmation(user, 'reset_password')
+    # the new confirmation replaces the previous one
+    assert not await storage.get_confirmation({'code': first['code']})
+
+    found = await storage.get_confirmation({'code': confirmation['code']})
+    assert found['action'] == 'reset_password'
+    found = await storage.get_confirmation(
+        {'user': user, 'action': 'reset_password'})
+    assert found['code'] == confirmation['code']
+
+    await storage.delete_confirmation(confirmation)
+    assert not await storage.get_confirmation({'code': confirmation['code']})
+    await storage.delete_user(user)
+
+
+async def test_consume_registration(storage):
+    user = await storage.create_user(new_user_data(status='confirmation'))
+    confirmation = await storage.create_confirmation(user, 'registration')
+
+    # expired
+    assert await storage.consume_confirmation(
+        confirmation['code'], cutoffs(age=timedelta(0))) == (None, None)
+
+    consumed, activated = await storage.consume_confirmation(
+        confirmation['code'], cutoffs())
+    assert consumed['action'] == 'registration'
+    assert activated['status'] == 'active'
+    assert await storage.consume_confirmation(
+        confirmation['code'], cutoffs()) == (None, None)
+    await storage.delete_user(activated)
+
+
+async def test_consume_change_email(storage):
+    user = await storage.create_user(new_user_data())
+    email = new_user_data()['email']
+    confirmation = await storage.create_confirmation(
+        user, 'change_email', email)
+    _, changed = await storage.consume_confirmation(
+        confirmation['code'], cutoffs())
+    assert changed['email'] == email
+    assert await storage.get_user({'email': email})
+    await storage.delete_user(changed)
+
+
+async def test_confirmations_reference_users(storage):
+    if isinstance(storage, MotorStorage):
+        pytest.skip('no references in mongodb')
+    user = await storage.create_user(new_user_data())
+    confirmation = await storage.create_confirmation(user, 'reset_password')
+    with pytest.raises(FOREIGN_KEY_ERRORS):
+        await storage.delete_user(user)
+    await storage.delete_confirmation(confirmation)
+    await storage.delete_user(user)
+
+
+async def test_consume_confirmation_of_deleted_user(storage):
+    if not isinstance(storage, MotorStorage):
+        pytest.skip('confirmations reference users')
+    user = await storage.create_user(new_user_data(status='confirmation'))
+    confirmation = await storage.create_confirmation(user, 'registration')
+    await storage.delete_user(user)
+    assert await storage.consume_confirmation(
+        confirmation['code'], cutoffs()) == (None, None)
+
+
+async def test_delete_expired_confirmations(storage):
+    user = await storage.create_user(new_user_data(status='confirmation'))
+    await storage.create_confirmation(user, 'registration')
+    active = await storage.create_user(new_user_data())
+    await storage.create_confirmation(active, 'reset_password')
+
+    assert await storage.delete_expired_confirmations(cutoffs(), 10) == (
+        0, [])
+    confirmations, user_ids = await storage.delete_expired_confirmations(
+        cutoffs(age=timedelta(0)), 10)
+    assert confirmations == 2
+    assert user_ids == [user_id(storage, user)]
+    assert not await storage.get_user({'email': user['email']})
+    assert await storage.get_user({'email': active['email']})
+    await storage.delete_user(active)
+
+
+async def test_instrumented_storage(storage):
+    registry = Registry()
+    storage = InstrumentedStorage(storage, registry)
+    user = await storage.create_user(new_user_data())
+    await storage.get_user({'email': user['email']})
+    await storage.get_user(filter={'email': user['email']})
+    with pytest.raises(DUPLICATE_ERRORS):
+        await storage.create_user(new_user_data(email=user['email']))
+    await storage.delete_user(user)
+
+    calls = registry.metrics['aiohttp_login_storage_call_seconds'].samples()
+    assert calls[('get_user', 'email')]['count'] == 2
+    assert calls[('create_user', '')]['count'] == 2
+    errors = registry.metrics['aiohttp_login_storage_errors_total'].samples()
+    assert sum(errors.values()) == 1
+
+
+async def test_coalescing_storage(storage):
+    storage = CoalescingStorage(storage)
+    user = await storage.create_user(new_user_data(status='confirmation'))
+    uid = user_id(storage, user)
+
+    users = await asyncio.gather(*[
+        storage.get_user({'id': uid}, fields=('email', 'id'))
+        for _ in range(3)])
+    assert [u['email'] for u in users] == [user['email']] * 3
+    assert users[0] is not users[1]
+    assert storage.stats() == {'calls': 1, 'coalesced': 2, 'in_flight': 0}
+    # other fields is another call
+    await asyncio.gather(storage.get_user({'id': uid}, fields=('email', 'id')),
+                         storage.get_user({'id': uid}))
+    assert storage.stats()['calls'] == 3
+
+    confirmation = await storage.create_confirmation(user, 'registration')
+    code = confirmation['code']
+    reading = asyncio.ensure_future(storage.get_confirmation({'code': code}))
+    await asyncio.sleep(0)
+    assert storage.stats()['in_flight'] == 1
+    await storage.consume_confirmation(code, cutoffs())
+    # the read started before consuming isn't shared with the later one
+    assert not await storage.get_confirmation({'code': code})
+    await reading
+    assert storage.stats()['calls'] == 5
+    await storage.delete_user(user)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '--maxfail=1'])
@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+from aiohttp_session import SimpleCookieStorage
+
+from utils import get_csrf, NewUser, log_client_in, create_client
+from utils import *  # noqa
+from utils import TIMED_CONFIG
+from aiohttp_login import cfg, url_for
+from aiohttp_login.timing import Timer, phase, _timer
+
+
+async def test_login_server_timing(timed_client, monkeypatch):
+    client = timed_client
+    url = url_for('auth_login')
+    r = await client.get(url)
+    assert 'render;dur=' in r.headers['Server-Timing']
+    async with NewUser() as user:
+        r = await client.post(url, data={
+            'email': user['email'],
+            'password': user['raw_password'],
+            'csrf_token': await get_csrf(r),
+        }, allow_redirects=False)
+    phases = [m.split(';')[0] for m in r.headers['Server-Timing'].split(', ')]
+    assert set(phases) == {'session', 'form', 'storage', 'hash', 'total'}
+
+    monkeypatch.setitem(cfg, 'SERVER_TIMING_SAMPLE_RATE', 0)
+    r = await client.get(url)
+    assert 'Server-Timing' not in r.headers
+
+
+async def test_lazy_user_timing(timed_client):
+    user = await log_client_in(timed_client)
+    # the user is loaded by a task of its own
+    r = await timed_client.get(url_for('lazy_user'))
+    assert (await r.json()) == {'email': user['email']}
+    assert 'storage;dur=' in r.headers['Server-Timing']
+    await cfg.STORAGE.delete_user(user)
+
+
+class SlowSessionStorage(SimpleCookieStorage):
+    async def load_session(self, request):
+        await asyncio.sleep(0.05)
+        return await super().load_session(request)
+
+
+@pytest.fixture
+def slow_session_client(loop, test_client, monkeypatch):
+    return create_client(loop, test_client, monkeypatch, 'memory',
+                         TIMED_CONFIG, SlowSessionStorage())
+
+
+async def test_session_load_is_timed(slow_session_client):
+    # the session is loaded by the flash middleware
+    r = await slow_session_client.get(url_for('auth_login'))
+    phases = dict(m.split(';dur=')
+                  for m in r.headers['Server-Timing'].split(', '))
+    assert float(phases['session']) >= 50
+    assert float(phases['total']) >= 50
+
+
+async def test_concurrent_phases(loop):
+    timer = Timer()
+    token = _timer.set(timer)
+
+    async def storage_call(delay):
+        with phase('storage'):
+            await asyncio.sleep(delay)
+
+    try:
+        with phase('form'):
+            await asyncio.gather(storage_call(0.01), storage_call(0.02))
+    finally:
+        _timer.reset(token)
+    storage, calls = timer.phases['storage']
+    assert calls == 2 and storage >= 0.03
+    # the form is still parsing while the calls are running
+    assert timer.phases['form'][0] >= 0.02
+    assert not timer.stacks
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '--maxfail=1'])
@@ -1,5 +1,7 @@
 import os
 import sys
+import sqlite3
+import tempfile
 from pathlib import Path
 sys.path.insert(0, str(Path(__file__).resolve().parents[1]))  # noqa
 
@@ -16,20 +18,38 @@ import aiohttp_login.utils
 from aiohttp_login.utils import get_random_string, encrypt_password
 from aiohttp_login.asyncpg_storage import AsyncpgStorage
 from aiohttp_login.motor_storage import MotorStorage
-from aiohttp_login import cfg, url_for, restricted_api
+from aiohttp_login.memory_storage import InMemoryStorage
+from aiohttp_login.sqlite_storage import SqliteStorage
+from aiohttp_login.sharded_storage import ShardedStorage, MemoryShardIndex
+from aiohttp_login.cache import UserCache
+from aiohttp_login import cfg, url_for, restricted_api, user_to_request
 
 
 DATABASE = 'aiohttp_login_tests'
+SQLITE_PATH = os.path.join(tempfile.gettempdir(), DATABASE + '.sqlite')
+STORAGES = ['asyncpg', 'motor', 'memory', 'sqlite', 'sharded']
+CONFIG = {
+    'CSRF_SECRET': 'secret',
+    'LOGIN_REDIRECT': 'auth_change_email',
+    'SMTP_SENDER': 'Your Name <your@gmail.com>',
+    'SMTP_HOST': 'smtp.gmail.com',
+    'SMTP_PORT': 465,
+    'SMTP_USERNAME': 'your@gmail.com',
+    'SMTP_PASSWORD': 'password',
+    'METRICS_URL': '/auth/metrics',
+}
+TIMED_CONFIG = dict(CONFIG, SERVER_TIMING_SAMPLE_RATE=1)
 
 
 def pytest_generate_tests(metafunc):
-    if 'client' in metafunc.fixturenames:
-        metafunc.parametrize('client', ['asyncpg', 'motor'], indirect=True)
+    for fixture in ['client', 'timed_client', 'storage']:
+        if fixture in metafunc.fixturenames:
+            metafunc.parametrize(fixture, STORAGES, indirect=True)
 
 
-async def create_app(loop, db):
+async def create_app(loop, db, config=CONFIG, session_storage=None):
     app = web.Application(loop=loop, middlewares=[
-        session_middleware(SimpleCookieStorage()),
+        session_middleware(session_storage or SimpleCookieStorage()),
     ])
     app.middlewares.append(aiohttp_login.flash.middleware)
     aiohttp_jinja2.setup(
@@ -38,25 +58,8 @@ async def create_app(loop, db):
         context_processors=[aiohttp_login.flash.context_processor],
     )
 
-    if db == 'asyncpg':
-        pool = await asyncpg.create_pool(
-            dsn='postgres:///' + DATABASE, loop=loop)
-        storage = AsyncpgStorage(pool)
-    elif db == 'motor':
-        app['db'] = AsyncIOMotorClient(io_loop=loop)[DATABASE]
-        storage = MotorStorage(app['db'])
-    else:
-        assert 0, 'unknown storage'
-
-    aiohttp_login.setup(app, storage, {
-        'CSRF_SECRET': 'secret',
-        'LOGIN_REDIRECT': 'auth_change_email',
-        'SMTP_SENDER': 'Your Name <your@gmail.com>',
-        'SMTP_HOST': 'smtp.gmail.com',
-        'SMTP_PORT': 465,
-        'SMTP_USERNAME': 'your@gmail.com',
-        'SMTP_PASSWORD': 'password'
-    })
+    storage = await create_storage(loop, db)
+    aiohttp_login.setup(app, storage, config)
 
     @restricted_api
     async def api_hello_handler(request):
@@ -64,6 +67,15 @@ async def create_app(loop, db):
 
     app.router.add_get('/api/hello', api_hello_handler, name='api_hello')
 
+    @user_to_request(lazy=True)
+    async def lazy_user_handler(request):
+        user = await request[cfg.REQUEST_USER_KEY]
+        # the second await gets the memoized user
+        assert user is await request[cfg.REQUEST_USER_KEY]
+        return web.json_response({'email': user and user['email']})
+
+    app.router.add_get('/lazy-user', lazy_user_handler, name='lazy_user')
+
     return app
 
 
@@ -73,13 +85,66 @@ async def get_csrf(r):
         '"')[0]
 
 
+async def create_storage(loop, db):
+    if db == 'asyncpg':
+        pool = await asyncpg.create_pool(
+            dsn='postgres:///' + DATABASE, loop=loop)
+        return AsyncpgStorage(pool)
+    elif db == 'motor':
+        mongo = AsyncIOMotorClient(io_loop=loop)[DATABASE]
+        return MotorStorage(mongo)
+    elif db == 'memory':
+        return InMemoryStorage()
+    elif db == 'sqlite':
+        with sqlite3.connect(SQLITE_PATH) as conn, \
+                open('aiohttp_login/sqlite_tables.sql') as f:
+            conn.executescript(f.read())
+        storage = SqliteStorage(SQLITE_PATH)
+        await storage.connect()
+        return storage
+    elif db == 'sharded':
+        return ShardedStorage([InMemoryStorage(), InMemoryStorage()],
+                              index=MemoryShardIndex())
+    else:
+        assert 0, 'unknown storage'
+
+
 @pytest.fixture
 def client(loop, test_client, monkeypatch, request):
+    return create_client(loop, test_client, monkeypatch, request.param)
+
+
+@pytest.fixture
+def timed_client(loop, test_client, monkeypatch, request):
+    '''Client of an app with every request timed'''
+    return create_client(loop, test_client, monkeypatch, request.param,
+                         TIMED_CONFIG)
+
+
+def create_client(loop, test_client, monkeypatch, db, config=CONFIG,
+                  session_storage=None):
     path_mail(monkeypatch)
-    app = loop.run_until_complete(create_app(loop, db=request.param))
-    loop.run_until_complete(prepare_db(app, request.param))
-    client = loop.run_until_complete(test_client(app))
-    return client
+    app = loop.run_until_complete(
+        create_app(loop, db, config, session_storage))
+    loop.run_until_complete(prepare_db(cfg.STORAGE, db))
+    return loop.run_until_complete(test_client(app))
+
+
+@pytest.fixture
+def storage(loop, request):
+    yield from storage_of(loop, request.param)
+
+
+def storage_of(loop, db):
+    '''Body of fixtures of a single storage, for tests of its specifics'''
+    if db not in STORAGES:
+        pytest.skip('{} is disabled'.format(db))
+    storage = loop.run_until_complete(create_storage(loop, db))
+    cfg.configure(dict(CONFIG, APP=None, STORAGE=storage))
+    loop.run_until_complete(prepare_db(storage, db))
+    yield storage
+    if hasattr(storage, 'on_cleanup'):
+        loop.run_until_complete(storage.on_cleanup(None))
 
 
 def path_mail(monkeypatch):
@@ -89,13 +154,14 @@ def path_mail(monkeypatch):
     monkeypatch.setattr(aiohttp_login.utils, 'send_mail', send_mail)
 
 
-async def prepare_db(app, db):
+async def prepare_db(storage, db):
     if db == 'asyncpg':
         os.system('psql -d {} -f aiohttp_login/pg_tables.sql'.format(DATABASE))
     elif db == 'motor':
-        await app['db']['users'].remove({})
-        await app['db']['confirmations'].remove({})
-    else:
+        await storage.users.remove({})
+        await storage.confirmations.remove({})
+        await storage.ensure_indexes()
+    elif db not in ('memory', 'sqlite', 'sharded'):
         assert 0, 'Unknown db'
 
 
@@ -152,6 +218,16 @@ async def create_user(data=None):
     return user
 
 
+def set_user_cache(monkeypatch):
+    '''Sets a user cache to the storage under the wrappers'''
+    storage = cfg.STORAGE
+    while 'storage' in vars(storage):
+        storage = storage.storage
+    cache = UserCache()
+    monkeypatch.setattr(storage, 'user_cache', cache)
+    return cache
+
+
 def parse_link(text):
     link = text.split('<a href="')[1].split('"')[0]
     assert '/auth/confirmation/' in link